@@ -0,0 +1,145 @@
+import numpy as np
+import pytest
+import torch
+from scipy import sparse
+from helical.models.scgpt.tasks import cell_emb
+from helical.models.scgpt.tasks.cell_emb import Dataset, _write_gathered, get_batch_cell_embeddings
+from helical.models.scgpt.data_collator import DataCollator
+from helical.models.scgpt.model_dir.model import TransformerModel
+
+COUNT_MATRIX = np.array([[0, 2, 0, 1],
+                         [3, 0, 0, 0],
+                         [0, 0, 0, 0]], dtype=np.float32)
+GENE_IDS = np.array([10, 11, 12, 13])
+VOCAB = {"<cls>": 1}
+MODEL_CONFIGS = {"pad_value": -2}
+
+@pytest.mark.parametrize("count_matrix", [
+    COUNT_MATRIX,
+    sparse.csr_matrix(COUNT_MATRIX),
+    sparse.csc_matrix(COUNT_MATRIX),
+])
+def test_dataset_dense_and_sparse_items_match(count_matrix):
+    """
+    Test that the dataset yields the same genes and expressions for dense and sparse count matrices.
+
+    Args:
+        count_matrix: The count matrix in dense or sparse format.
+    """
+    dataset = Dataset(count_matrix, GENE_IDS, VOCAB, MODEL_CONFIGS)
+    assert len(dataset) == 3
+
+    item = dataset[0]
+    assert torch.equal(item["genes"], torch.tensor([1, 11, 13]))
+    assert torch.equal(item["expressions"], torch.tensor([-2., 2., 1.]))
+
+    item = dataset[2]
+    assert torch.equal(item["genes"], torch.tensor([1]))
+    assert torch.equal(item["expressions"], torch.tensor([-2.]))
+
+def test_dataset_ignores_explicit_zeros():
+    """
+    Test that explicitly stored zeros in a sparse count matrix are not turned into tokens.
+    """
+    count_matrix = sparse.csr_matrix((np.array([0., 5.]), np.array([0, 2]), np.array([0, 2])), shape=(1, 4))
+    item = Dataset(count_matrix, GENE_IDS, VOCAB, MODEL_CONFIGS)[0]
+    assert torch.equal(item["genes"], torch.tensor([1, 12]))
+    assert torch.equal(item["expressions"], torch.tensor([-2., 5.]))
+
+def test_dataset_drops_genes_not_in_vocab():
+    """
+    Test that genes with a negative vocabulary id, as passed for backed data, are dropped from the items.
+    """
+    gene_ids = np.array([10, -1, 12, 13])
+    item = Dataset(COUNT_MATRIX, gene_ids, VOCAB, MODEL_CONFIGS)[0]
+    assert torch.equal(item["genes"], torch.tensor([1, 13]))
+    assert torch.equal(item["expressions"], torch.tensor([-2., 1.]))
+
+def test_write_gathered_with_prepared_loader_read_one_batch_ahead():
+    """
+    Test that all the cells are written when a prepared dataloader is read one batch ahead, as `_iter_on_device` does on CUDA.
+    With 100 cells and a batch size of 24, accelerate already flags the end of the dataloader while the fourth batch is processed.
+    """
+    from accelerate import Accelerator
+    from torch.utils.data import DataLoader, TensorDataset
+
+    num_cells = 100
+    accelerator = Accelerator(cpu=True)
+    data_loader = accelerator.prepare(DataLoader(TensorDataset(torch.arange(num_cells, dtype=torch.float32)), batch_size=24))
+
+    cell_embeddings = torch.full((num_cells, 1), -1.)
+    count = 0
+    data_iter = iter(data_loader)
+    next_batch = next(data_iter, None)
+    while next_batch is not None:
+        batch, next_batch = next_batch, next(data_iter, None)
+        count = _write_gathered(cell_embeddings, batch[0].unsqueeze(1), count, accelerator)
+
+    assert count == num_cells
+    assert torch.equal(cell_embeddings[:, 0], torch.arange(num_cells, dtype=torch.float32))
+
+def _get_tiny_model(vocab):
+    torch.manual_seed(0)
+    return TransformerModel(ntoken=len(vocab), d_model=16, nhead=2, d_hid=32, nlayers=1, 
+                            vocab=vocab, pad_token="<pad>", pad_value=-2, dropout=0.0).eval()
+
+def test_padding_to_multiple_of_8_does_not_change_embeddings(monkeypatch):
+    """
+    Test that with a max_length which is not a multiple of 8, the cell embeddings match the ones of batches that are not padded to a multiple of 8.
+    The cells have more genes than max_length or fewer, so that both the sampled and the padded batches are covered.
+    """
+    from anndata import AnnData
+    num_genes = 60
+    vocab = {"<pad>": 0, "<cls>": 1, **{f"gene{i}": i + 2 for i in range(num_genes)}}
+    rng = np.random.default_rng(0)
+    count_matrix = rng.integers(1, 10, size=(6, num_genes)).astype(np.float32)
+    count_matrix[3:, 4:] = 0
+    adata = AnnData(X=count_matrix)
+    gene_ids = np.arange(num_genes) + 2
+    model_configs = {"pad_token": "<pad>", "pad_value": -2, "embsize": 16, "precision": "fp32"}
+    model = _get_tiny_model(vocab)
+
+    def embed():
+        torch.manual_seed(0)
+        np.random.seed(0)
+        return get_batch_cell_embeddings(adata, model=model, vocab=vocab, max_length=13, batch_size=3, 
+                                         model_configs=model_configs, gene_ids=gene_ids)
+
+    padded = embed()
+    monkeypatch.setattr(cell_emb, "DataCollator", lambda **kwargs: DataCollator(**{**kwargs, "pad_to_multiple_of": None}))
+    unpadded = embed()
+    np.testing.assert_allclose(padded, unpadded, atol=1e-5)
+
+@pytest.mark.parametrize("to_matrix", [np.array, sparse.csr_matrix])
+def test_backed_and_in_memory_data_give_the_same_embeddings(tmp_path, to_matrix):
+    """
+    Test that an AnnData read in backed mode, where the genes not in the vocabulary are dropped row by row,
+    gives the same embeddings as the AnnData in memory, where they are dropped by subsetting the genes.
+
+    Args:
+        tmp_path: The pytest temporary directory.
+        to_matrix: Converts the expression matrix to the format written to the .h5ad file.
+    """
+    import anndata as ad
+    import pandas as pd
+    from helical.models.scgpt.scgpt_utils import get_embedding
+
+    vocab = {"<pad>": 0, "<cls>": 1, "a": 2, "b": 3, "c": 4}
+    count_matrix = np.array([[1, 0, 2, 5],
+                             [0, 3, 4, 0],
+                             [2, 2, 0, 1]], dtype=np.float32)
+    var = pd.DataFrame({"gene_symbols": ["a", "not_in_vocab", "b", "c"]}, index=["g1", "g2", "g3", "g4"])
+    adata_path = tmp_path / "data.h5ad"
+    ad.AnnData(X=to_matrix(count_matrix), var=var).write_h5ad(adata_path)
+    model_configs = {"pad_token": "<pad>", "pad_value": -2, "embsize": 16, "precision": "fp32"}
+    model = _get_tiny_model(vocab)
+
+    def embed(adata):
+        torch.manual_seed(0)
+        np.random.seed(0)
+        return get_embedding(adata, model_configs=model_configs, model=model, vocab=vocab, vocab_stoi=vocab, 
+                             gene_col="gene_symbols", batch_size=2, device="cpu")
+
+    in_memory = embed(ad.read_h5ad(adata_path))
+    backed = embed(ad.read_h5ad(adata_path, backed="r"))
+    np.testing.assert_allclose(backed, in_memory, atol=1e-6)
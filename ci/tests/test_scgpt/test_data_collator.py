@@ -0,0 +1,24 @@
+import pytest
+import torch
+from helical.models.scgpt.data_collator import DataCollator
+
+@pytest.mark.parametrize("num_genes, expected_length", [
+    (5, 8),
+    (8, 8),
+    (9, 16),
+    (30, 20),
+])
+def test_data_collator_pad_to_multiple_of(num_genes, expected_length):
+    """
+    Test that the collator pads the batch to a multiple of 8, capped at max_length.
+
+    Args:
+        num_genes (int): The number of genes of the example.
+        expected_length (int): The expected sequence length of the batch.
+    """
+    collator = DataCollator(pad_token_id=0, pad_value=-2, do_mlm=False, do_binning=False, 
+                            max_length=20, pad_to_multiple_of=8)
+    example = {"genes": torch.arange(1, num_genes + 1), "expressions": torch.ones(num_genes)}
+    data_dict = collator([example])
+    assert data_dict["gene"].shape == (1, expected_length)
+    assert torch.all(data_dict["gene"][0, num_genes:] == 0)
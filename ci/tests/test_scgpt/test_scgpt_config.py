@@ -0,0 +1,39 @@
+from helical.models.scgpt.model import scGPTConfig
+import pytest
+
+@pytest.mark.parametrize("precision", ["fp32", "fp16", "bf16"])
+def test_scgpt_config_precision(precision):
+    """
+    Test case for the precision of the scGPT config.
+
+    Args:
+        precision (str): The precision used for inference.
+    """
+    configurer = scGPTConfig(precision=precision)
+    assert configurer.config["precision"] == precision
+
+def test_scgpt_config_default_precision():
+    """
+    Test case for the default precision of the scGPT config, which should be bfloat16.
+    """
+    configurer = scGPTConfig()
+    assert configurer.config["precision"] == "bf16"
+
+@pytest.mark.parametrize("use_tf32", [True, False])
+def test_scgpt_config_use_tf32(use_tf32):
+    """
+    Test case for the TF32 flag of the scGPT config.
+
+    Args:
+        use_tf32 (bool): Whether to allow TF32 on CUDA.
+    """
+    configurer = scGPTConfig(use_tf32=use_tf32)
+    assert configurer.config["use_tf32"] == use_tf32
+
+def test_scgpt_config_compile_is_off_by_default():
+    """
+    Test case for the default compile flags of the scGPT config.
+    """
+    configurer = scGPTConfig()
+    assert configurer.config["compile"] == False
+    assert configurer.config["compile_mode"] == "reduce-overhead"
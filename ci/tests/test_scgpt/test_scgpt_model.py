@@ -0,0 +1,83 @@
+from helical.models.scgpt import model as scgpt_model
+from helical.models.scgpt.model import scGPT, scGPTConfig
+from anndata import AnnData
+import numpy as np
+import pandas as pd
+import pytest
+
+EMBSIZE = 4
+
+@pytest.fixture
+def scgpt(monkeypatch):
+    """An scGPT model without weights, whose embeddings are counted calls of `get_embedding`."""
+    scgpt = scGPT.__new__(scGPT)
+    scgpt.config = scGPTConfig(embsize=EMBSIZE).config
+    scgpt.gene_column_name = "gene_symbols"
+    scgpt.accelerator = None
+    scgpt.model = scgpt.vocab = scgpt._vocab_stoi = None
+    scgpt.num_inferences = 0
+
+    def get_embedding(data, **kwargs):
+        scgpt.num_inferences += 1
+        return np.full((data.n_obs, EMBSIZE), scgpt.num_inferences, dtype=np.float32)
+
+    monkeypatch.setattr(scgpt_model, "get_embedding", get_embedding)
+    return scgpt
+
+def _get_data(obs_names, gene_symbols=("a", "b")):
+    return AnnData(X=np.ones((len(obs_names), len(gene_symbols)), dtype=np.float32), 
+                   obs=pd.DataFrame(index=list(obs_names)),
+                   var=pd.DataFrame({"gene_symbols": list(gene_symbols)}, index=list(gene_symbols)))
+
+def test_get_embeddings_saves_and_loads(scgpt, tmp_path):
+    """
+    Test that the embeddings are saved to output_path and loaded from it on the next call, without running the model again.
+    """
+    output_path = tmp_path / "embeddings.npy"
+    data = _get_data(["c1", "c2"])
+    embeddings = scgpt.get_embeddings(data, output_path=output_path)
+    np.testing.assert_array_equal(np.load(output_path), embeddings)
+
+    np.testing.assert_array_equal(scgpt.get_embeddings(data, output_path=output_path), embeddings)
+    assert scgpt.num_inferences == 1
+
+@pytest.mark.parametrize("other_data", [
+    _get_data(["c3", "c4"]),
+    _get_data(["c1", "c2"], gene_symbols=("a", "c")),
+    _get_data(["c1", "c2", "c3"]),
+])
+def test_get_embeddings_recomputes_for_other_data(scgpt, tmp_path, other_data):
+    """
+    Test that the saved embeddings are recomputed for other cells or genes, even if the number of cells matches.
+
+    Args:
+        other_data (AnnData): The data the embeddings are computed for after they were saved for two other cells.
+    """
+    output_path = tmp_path / "embeddings.npy"
+    scgpt.get_embeddings(_get_data(["c1", "c2"]), output_path=output_path)
+    embeddings = scgpt.get_embeddings(other_data, output_path=output_path)
+    assert scgpt.num_inferences == 2
+    assert embeddings.shape == (other_data.n_obs, EMBSIZE)
+    assert np.all(embeddings == 2)
+
+def test_get_embeddings_recomputes_for_another_config(scgpt, tmp_path):
+    """
+    Test that the saved embeddings are recomputed if the config changed.
+    """
+    output_path = tmp_path / "embeddings.npy"
+    data = _get_data(["c1", "c2"])
+    scgpt.get_embeddings(data, output_path=output_path)
+    scgpt.config["precision"] = "fp32"
+    scgpt.get_embeddings(data, output_path=output_path)
+    assert scgpt.num_inferences == 2
+
+def test_get_embeddings_does_not_overwrite_other_files(scgpt, tmp_path):
+    """
+    Test that a file at output_path which is not a .npy file raises a ValueError and is left untouched.
+    """
+    output_path = tmp_path / "embeddings.npy"
+    output_path.write_text("not embeddings")
+    with pytest.raises(ValueError):
+        scgpt.get_embeddings(_get_data(["c1", "c2"]), output_path=output_path)
+    assert output_path.read_text() == "not embeddings"
+    assert scgpt.num_inferences == 0
@@ -0,0 +1,19 @@
+from helical.models.uce.gene_embeddings import load_gene_embeddings_adata
+from anndata import AnnData
+import numpy as np
+import pandas as pd
+import torch
+
+def test_load_gene_embeddings_adata(tmp_path):
+    """
+    Test that the genes without embeddings are filtered out, independently of the case of the gene symbols.
+
+    Args:
+        tmp_path: The pytest temporary directory.
+    """
+    torch.save({"A": torch.zeros(2), "b": torch.ones(2)}, tmp_path / "Homo_sapiens.GRCh38.gene_symbol_to_embedding_ESM2.pt")
+    adata = AnnData(X=np.ones((2, 3)), var=pd.DataFrame(index=["a", "C", "B"]))
+
+    filtered_adata, species_to_all_gene_symbols = load_gene_embeddings_adata(adata, ["human"], "ESM2", tmp_path)
+    assert list(filtered_adata.var_names) == ["a", "B"]
+    assert species_to_all_gene_symbols == {"human": ["a", "b"]}
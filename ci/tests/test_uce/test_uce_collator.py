@@ -0,0 +1,26 @@
+from helical.models.uce.uce_collator import UCECollator
+import torch
+
+def _get_sample(seq_len: int, pad_length: int, value: int):
+    bs = torch.zeros((1, pad_length)).long()
+    bs[0, :seq_len] = value
+    msk = torch.zeros((1, pad_length))
+    msk[0, :seq_len] = 1
+    return bs, msk, value, seq_len, bs.float()
+
+def test_uce_collator_returns_sequence_first_batch_sentences():
+    """
+    Test that the collator returns the batch sentences as (seq_len, batch_size), cut to the longest sequence,
+    and the mask as (batch_size, seq_len).
+    """
+    collator = UCECollator({"pad_length": 8})
+    batch_sentences, mask, idxs, cell_sentences = collator([_get_sample(3, 8, 5), _get_sample(5, 8, 7)])
+
+    assert batch_sentences.shape == (5, 2)
+    assert batch_sentences.is_contiguous()
+    assert batch_sentences.dtype == torch.int64
+    assert torch.equal(batch_sentences[:, 0], torch.tensor([5, 5, 5, 0, 0]))
+    assert torch.equal(batch_sentences[:, 1], torch.tensor([7, 7, 7, 7, 7]))
+    assert mask.shape == (2, 5)
+    assert torch.equal(idxs, torch.tensor([5., 7.]))
+    assert cell_sentences.shape == (2, 8)
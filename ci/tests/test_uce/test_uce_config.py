@@ -33,3 +33,20 @@ def test_uce_config__invalid_model_names(model_name):
     """
     with pytest.raises(ValueError):
         UCEConfig(model_name=model_name)
+
+@pytest.mark.parametrize("precision", ["fp32", "fp16", "bf16"])
+def test_uce_config_precision(precision):
+    """
+    Test case for the precision of the UCE config.
+
+    Args:
+        precision (str): The precision used for inference.
+    """
+    configurer = UCEConfig(precision=precision)
+    assert configurer.config["precision"] == precision
+
+def test_uce_config_samples_in_main_process_by_default():
+    """
+    Test that the cell sentences are sampled in the main process by default, where np.random.seed controls the sampling.
+    """
+    assert UCEConfig().config["num_workers"] == 0
@@ -0,0 +1,32 @@
+from helical.models.uce.uce_cuda_graph import CUDAGraphForward
+from helical.models.uce.uce_model import TransformerModel
+from helical.models.uce.uce_utils import embed_and_normalize
+import pytest
+import torch
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="CUDA graphs need a GPU.")
+def test_cuda_graph_forward_matches_eager():
+    """
+    Test that the embeddings replayed from the CUDA graphs match the eager embeddings,
+    for batches of different lengths and a ragged last batch, as the UCE DataLoader yields them.
+    """
+    torch.manual_seed(0)
+    device = torch.device("cuda")
+    model = TransformerModel(token_dim=16, d_model=32, nhead=4, d_hid=64, nlayers=2, output_dim=16).to(device).eval()
+    pe_embedding = torch.nn.Embedding(10, 16).to(device)
+
+    def forward(batch_sentences, mask):
+        _, embedding = model.forward(embed_and_normalize(pe_embedding, batch_sentences), mask=mask)
+        return embedding.float()
+
+    graph_forward = CUDAGraphForward(forward)
+    with torch.inference_mode():
+        for seq_len, batch_size in [(7, 3), (9, 3), (7, 3), (5, 2)]:
+            batch_sentences = torch.randint(1, 10, (seq_len, batch_size), device=device)
+            mask = torch.ones((batch_size, seq_len), device=device)
+            mask[0, seq_len - 2:] = 0
+            batch_sentences[seq_len - 2:, 0] = 0
+            torch.testing.assert_close(graph_forward(batch_sentences, mask), forward(batch_sentences, mask))
+
+    assert not graph_forward.capture_failed
+    assert len(graph_forward.graphs) == 3
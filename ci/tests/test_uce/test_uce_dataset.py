@@ -0,0 +1,61 @@
+from helical.models.uce.uce_dataset import UCEDataset
+from helical.models.uce.uce_config import UCEConfig
+from helical.models.uce.uce_utils import prepare_expression_counts_file
+from scipy import sparse
+import numpy as np
+import pandas as pd
+import pickle
+import pytest
+import torch
+
+GENE_EXPRESSION = np.array([[1, 0, 2, 5],
+                            [0, 3, 0, 1],
+                            [4, 1, 1, 0]], dtype=np.float32)
+
+def _get_dataset(tmp_path, expression_counts=None):
+    return UCEDataset(sorted_dataset_names=["test"],
+                      shapes_dict={"test": GENE_EXPRESSION.shape},
+                      model_config=UCEConfig(pad_length=32, sample_size=8).config,
+                      expression_counts_path=f"{tmp_path}/",
+                      dataset_to_protein_embeddings=torch.tensor([10, 11, 12, 13]),
+                      datasets_to_chroms=pd.Series([0, 0, 1, 1]),
+                      datasets_to_starts=np.array([5, 1, 7, 3]),
+                      expression_counts=expression_counts)
+
+def _get_items(dataset):
+    items = []
+    for idx in range(len(dataset)):
+        np.random.seed(idx)
+        items.append(dataset[idx])
+    return items
+
+def _assert_items_equal(items, other_items):
+    for item, other_item in zip(items, other_items):
+        batch_sentences, mask, idx, seq_len, cell_sentences = item
+        other_batch_sentences, other_mask, other_idx, other_seq_len, other_cell_sentences = other_item
+        assert torch.equal(batch_sentences, other_batch_sentences)
+        assert torch.equal(mask, other_mask)
+        assert (idx, seq_len) == (other_idx, other_seq_len)
+        assert torch.equal(cell_sentences, other_cell_sentences)
+
+@pytest.mark.parametrize("in_memory_counts", [GENE_EXPRESSION, sparse.csr_matrix(GENE_EXPRESSION)])
+def test_in_memory_and_memory_mapped_counts_give_the_same_items(tmp_path, in_memory_counts):
+    """
+    Test that the dataset gives the same items from the expression counts in memory and from the counts file,
+    also after a pickle round-trip as for the DataLoader workers, which reopen the counts file instead of pickling the memory map.
+
+    Args:
+        tmp_path: The pytest temporary directory.
+        in_memory_counts: The dense or sparse expression counts handed to the dataset.
+    """
+    prepare_expression_counts_file(GENE_EXPRESSION, "test", f"{tmp_path}/")
+    memory_mapped = _get_dataset(tmp_path)
+    in_memory = _get_dataset(tmp_path, expression_counts={"test": in_memory_counts})
+    items = _get_items(memory_mapped)
+
+    _assert_items_equal(items, _get_items(in_memory))
+    _assert_items_equal(items, _get_items(pickle.loads(pickle.dumps(in_memory))))
+
+    unpickled = pickle.loads(pickle.dumps(memory_mapped))
+    assert unpickled.xs == {}
+    _assert_items_equal(items, _get_items(unpickled))
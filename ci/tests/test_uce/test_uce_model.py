@@ -0,0 +1,44 @@
+from helical.models.uce import model as uce_model
+from helical.models.uce.model import UCE
+from helical.models.uce.uce_config import UCEConfig
+from helical.models.uce.uce_utils import get_dataloader
+import torch
+
+class _Dataset(torch.utils.data.Dataset):
+    collator_fn = staticmethod(torch.utils.data.default_collate)
+
+    def __len__(self):
+        return 10
+
+    def __getitem__(self, idx):
+        return torch.tensor(idx)
+
+class _Accelerator():
+    def __init__(self):
+        self.num_prepared = 0
+
+    def prepare(self, dataloader):
+        self.num_prepared += 1
+        return dataloader
+
+def test_get_embeddings_does_not_prepare_the_tuned_dataloader_again(monkeypatch):
+    """
+    Test that with auto_batch_size, the DataLoader is rebuilt with the tuned batch size and prepared on the first call only.
+    """
+    uce = UCE.__new__(UCE)
+    uce.config = UCEConfig(device="cuda", auto_batch_size=True, num_workers=0).config
+    uce.device = "cuda"
+    uce.accelerator = _Accelerator()
+    uce._tuned_batch_size = 4
+    uce._tuned_dataloaders = (None, None)
+    batch_sizes = []
+    monkeypatch.setattr(uce_model, "get_gene_embeddings", lambda model, dataloader, *args, **kwargs: batch_sizes.append(dataloader.batch_size))
+    for attribute in ["model", "autocast_dtype", "embed_fn", "_pe_embedding"]:
+        setattr(uce, attribute, None)
+
+    dataloader = get_dataloader(_Dataset(), uce.config, batch_size=5)
+    uce.get_embeddings(dataloader)
+    uce.get_embeddings(dataloader)
+
+    assert batch_sizes == [4, 4]
+    assert uce.accelerator.num_prepared == 1
@@ -0,0 +1,109 @@
+from helical.models.uce.uce_utils import prepare_expression_counts_file, get_protein_embeddings_idxs, embed_and_normalize, filter_genes, preload_batches
+from helical.models.inference_utils import get_autocast_dtype
+from anndata import AnnData
+from scipy import sparse
+import numpy as np
+import pandas as pd
+import pickle
+import pytest
+import torch
+
+GENE_EXPRESSION = np.array([[0, 1, 0],
+                            [2, 0, 3],
+                            [0, 0, 0],
+                            [4, 0, 5],
+                            [0, 6, 0]])
+
+@pytest.mark.parametrize("gene_expression", [
+    GENE_EXPRESSION,
+    sparse.csr_matrix(GENE_EXPRESSION),
+])
+def test_prepare_expression_counts_file(tmp_path, gene_expression):
+    """
+    Test that dense and sparse expression matrices are written to the counts file in chunks.
+
+    Args:
+        tmp_path: The pytest temporary directory.
+        gene_expression: The dense or sparse expression matrix.
+    """
+    prepare_expression_counts_file(gene_expression, "test", f"{tmp_path}/", chunk_size=2)
+    counts = np.memmap(f"{tmp_path}/test_counts.npz", dtype='float32', mode='r', shape=GENE_EXPRESSION.shape)
+    np.testing.assert_array_equal(counts, GENE_EXPRESSION)
+
+@pytest.mark.parametrize("precision", ["fp32", "fp16", "bf16"])
+def test_get_autocast_dtype_on_cpu(precision):
+    """
+    Test that inference on CPU always runs in full precision.
+
+    Args:
+        precision (str): The requested precision.
+    """
+    assert get_autocast_dtype("cpu", precision) is None
+
+def test_get_protein_embeddings_idxs(tmp_path):
+    """
+    Test that the protein embedding indexes are the positions of the genes in the species gene list plus the species offset.
+    The first position is used for gene symbols that appear twice, as with list.index().
+
+    Args:
+        tmp_path: The pytest temporary directory.
+    """
+    offset_pkl_path = tmp_path / "species_offsets.pkl"
+    with open(offset_pkl_path, "wb") as f:
+        pickle.dump({"human": 100}, f)
+    species_to_all_gene_symbols = {"human": ["a", "b", "c", "b"]}
+    adata = AnnData(X=np.zeros((1, 3)), var=pd.DataFrame(index=["C", "a", "B"]))
+
+    pe_row_idxs = get_protein_embeddings_idxs(offset_pkl_path, "human", species_to_all_gene_symbols, adata)
+    assert torch.equal(pe_row_idxs, torch.tensor([102, 100, 101]))
+
+def test_embed_and_normalize():
+    """
+    Test case for the protein embedding lookup, the token embeddings are unit vectors along the embedding dimension.
+    """
+    pe_embedding = torch.nn.Embedding(10, 4)
+    ids = torch.randint(0, 10, (6, 2))
+    embeddings = embed_and_normalize(pe_embedding, ids)
+    assert embeddings.shape == (6, 2, 4)
+    torch.testing.assert_close(embeddings.norm(dim=2), torch.ones(6, 2))
+
+@pytest.mark.parametrize("to_matrix", [np.array, sparse.csr_matrix, sparse.csc_matrix])
+def test_filter_genes(to_matrix):
+    """
+    Test that dense and sparse expression matrices keep the same genes, that only positive counts are counted,
+    and that the AnnData passed in is not modified.
+
+    Args:
+        to_matrix: Converts the expression matrix to the tested format.
+    """
+    X = np.array([[1, 0, -1, 2],
+                  [3, 0, -2, 0],
+                  [0, 5, 0, 0]], dtype=np.float32)
+    adata = AnnData(X=to_matrix(X), var=pd.DataFrame(index=["a", "b", "c", "d"]))
+
+    filtered_adata = filter_genes(adata, min_cells=1)
+    assert list(filtered_adata.var_names) == ["a", "b", "d"]
+    assert list(filter_genes(adata, min_cells=2).var_names) == ["a"]
+    assert adata.n_vars == 4
+
+class _SamplingDataset(torch.utils.data.Dataset):
+    config = {"pad_length": 8}
+
+    def __init__(self):
+        self.num_sampled = 0
+
+    def __len__(self):
+        return 4
+
+    def __getitem__(self, idx):
+        self.num_sampled += 1
+        return torch.zeros(8, dtype=torch.int64), torch.ones(8)
+
+def test_preload_batches_does_not_sample_when_the_batches_do_not_fit(monkeypatch):
+    """
+    Test that the batches are not sampled if they do not fit in the GPU memory, so that the random state of the sampling is left untouched for the fallback.
+    """
+    monkeypatch.setattr(torch.cuda, "mem_get_info", lambda device: (100, 1000))
+    dataset = _SamplingDataset()
+    assert preload_batches(torch.utils.data.DataLoader(dataset, batch_size=2), "cuda") is None
+    assert dataset.num_sampled == 0
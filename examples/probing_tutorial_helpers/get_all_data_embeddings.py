@@ -51,6 +51,11 @@ labels = get_dataset_config_names("InstaDeepAI/nucleotide_transformer_downstream
 for i, label in enumerate(labels):
     print(f"Processing '{label}' dataset: {i+1} of {len(labels)}")
 
+    # the embeddings only depend on the model and the dataset, skip the inference if they were saved in a previous run
+    if all(os.path.exists(f"data/{split}/{xy}_{label}_norm_256.npy") for split in ["train", "test"] for xy in ["x", "y"]):
+        print(f"Found the embeddings of '{label}' in the data folder, skipping.")
+        continue
+
     dataset = load_dataset("InstaDeepAI/nucleotide_transformer_downstream_tasks", label)
     x, y = get_model_inputs(dataset["train"], 50)
 
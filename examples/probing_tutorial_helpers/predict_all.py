@@ -1,9 +1,9 @@
+import tensorflow as tf
+from tensorflow.keras import mixed_precision
 from tensorflow.keras.models import Sequential
-from tensorflow.keras.layers import Dense, Dropout, BatchNormalization
+from tensorflow.keras.layers import Dense, Dropout, BatchNormalization, Activation
 from tensorflow.keras.callbacks import TensorBoard
 from tensorflow.keras.optimizers import Adam
-from tensorflow.keras.utils import to_categorical
-from tensorflow_addons.metrics import F1Score
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import LabelEncoder
 import numpy as np
@@ -13,6 +13,13 @@ import json
 
 configurer = HyenaDNAConfig(model_name="hyenadna-tiny-1k-seqlen-d256")
 
+# compute the dense layers in float16 on tensor cores, while keeping the variables in float32.
+# Set to False to train in float32. Without a GPU it is always off, float16 is slower than float32 on CPUs
+use_mixed_precision = True
+use_mixed_precision = use_mixed_precision and len(tf.config.list_physical_devices('GPU')) > 0
+if use_mixed_precision:
+    mixed_precision.set_global_policy('mixed_float16')
+
 from datasets import get_dataset_config_names
 from datasets import load_dataset
 from sklearn.metrics import matthews_corrcoef
@@ -29,10 +36,9 @@ for i, label in enumerate(configs):
 
     x = np.load(f"data/train/x_{label}_norm_256.npy")
     y = np.load(f"data/train/y_{label}_norm_256.npy")
-    # # One-hot encode the labels
+    # integer encode the labels, the sparse loss does not need a one-hot matrix
     encoder = LabelEncoder()
     y_encoded = encoder.fit_transform(y)
-    y_encoded = to_categorical(y_encoded, num_classes=num_classes)
 
     # X_train, X_test, y_train, y_test = train_test_split(x, y_encoded, test_size=0, random_state=42)
 
@@ -48,13 +54,17 @@ for i, label in enumerate(configs):
     head_model.add(Dropout(0.4))  
     head_model.add(Dense(64, activation='relu'))
     head_model.add(Dropout(0.4))  
-    head_model.add(Dense(num_classes, activation='softmax'))
+    head_model.add(Dense(num_classes, name='logits'))
+    # the softmax is kept in float32 for numerical stability
+    head_model.add(Activation('softmax', dtype='float32', name='predictions'))
 
     # compile the model
     optimizer = Adam(learning_rate=0.001)
-    f1_score = F1Score(num_classes, average='macro')
-
-    head_model.compile(loss='categorical_crossentropy', optimizer=optimizer, metrics=f1_score)
+    if use_mixed_precision:
+        optimizer = mixed_precision.LossScaleOptimizer(optimizer)
+    # the training metric is the accuracy on the integer labels, the F1 score of tensorflow_addons needed one-hot labels.
+    # The F1 score and the MCC of the unseen data are still computed with sklearn below
+    head_model.compile(loss='sparse_categorical_crossentropy', optimizer=optimizer, metrics=['sparse_categorical_accuracy'])
 
     # Setup callbacks
     log_dir = "logs/fit/" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
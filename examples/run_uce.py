@@ -3,8 +3,9 @@ import anndata as ad
 
 configurer=UCEConfig(batch_size=10)
 uce = UCE(configurer=configurer)
-ann_data = ad.read_h5ad("./10k_pbmcs_proc.h5ad")
-data_loader = uce.process_data(ann_data[:10])
+# open the file in backed mode to only read the first cells from disk
+ann_data = ad.read_h5ad("./10k_pbmcs_proc.h5ad", backed="r")[:10].to_memory()
+data_loader = uce.process_data(ann_data)
 embeddings = uce.get_embeddings(data_loader)
 
 print(embeddings.shape)
\ No newline at end of file
@@ -0,0 +1,78 @@
+"""
+    Helpers shared by the inference loops of the models.
+"""
+
+from typing import Optional, Union
+import torch
+
+def get_autocast_dtype(device: Union[str, torch.device], precision: str) -> Optional[torch.dtype]:
+    '''
+    Get the dtype to use for inference under autocast.
+
+    Args:
+        device: The device of the model
+        precision: One of "fp32", "fp16" and "bf16". "bf16" falls back to "fp16" if the GPU does not support bfloat16.
+
+    Returns:
+        The autocast dtype or None if the inference runs in full precision, which is always the case on CPU.
+    '''
+    if torch.device(device).type != "cuda" or precision == "fp32":
+        return None
+    if precision == "bf16" and torch.cuda.is_bf16_supported():
+        return torch.bfloat16
+    return torch.float16
+
+class CUDAPrefetcher(object):
+    '''
+    Wraps an iterable of batches and stages the next batch on the GPU on a side stream while the current batch is processed.
+    Modelled on the data prefetcher of the apex ImageNet example.
+
+    Args:
+        loader: The iterable of batches, each batch being a tuple, a list or a dict of tensors
+        device: The CUDA device to copy the tensors of the batches to
+        keys: The positions or the keys of the tensors to stage. Only these are copied and returned, by default all of them
+    '''
+    def __init__(self, loader, device, keys=None):
+        self.loader = loader
+        self.device = device
+        self.keys = keys
+        self.stream = torch.cuda.Stream(device=device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.iterator = iter(self.loader)
+        self.preload()
+        return self
+
+    def stage(self, batch):
+        if isinstance(batch, dict):
+            keys = batch.keys() if self.keys is None else self.keys
+            return {key: batch[key].to(self.device, non_blocking=True) for key in keys}
+        # the elements the consumer does not need are not copied at all
+        batch = batch if self.keys is None else [batch[key] for key in self.keys]
+        return [b.to(self.device, non_blocking=True) if isinstance(b, torch.Tensor) else b for b in batch]
+
+    def preload(self):
+        # fetching under the side stream also covers copies made by the loader itself, such as the accelerate device placement
+        with torch.cuda.stream(self.stream):
+            try:
+                batch = next(self.iterator)
+            except StopIteration:
+                self.next_batch = None
+                return
+            self.next_batch = self.stage(batch)
+
+    def __next__(self):
+        if self.next_batch is None:
+            raise StopIteration
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_stream(self.stream)
+        batch = self.next_batch
+        for b in (batch.values() if isinstance(batch, dict) else batch):
+            if isinstance(b, torch.Tensor):
+                # the tensor was allocated on the side stream but is consumed on the current stream
+                b.record_stream(current_stream)
+        self.preload()
+        return batch
@@ -32,6 +32,9 @@ class DataCollator:
             of the sequence to keep unchanged from sampling. This is useful when
             special tokens have been added to the beginning of the sequence.
             Default to 1.
+        pad_to_multiple_of (:obj:`int`, optional): if set, pad the sequences of
+            a batch to a multiple of this value (capped at max_length). Multiples
+            of 8 let fp16/bf16 matmuls run on tensor cores.
     """
 
     do_padding: bool = True
@@ -44,6 +47,7 @@ class DataCollator:
     max_length: Optional[int] = None
     sampling: bool = True
     keep_first_n_tokens: int = 1
+    pad_to_multiple_of: Optional[int] = None
 
     def __post_init__(self):
         if self.do_padding:
@@ -77,6 +81,11 @@ class DataCollator:
 
         max_ori_len = max(len(example["genes"]) for example in examples)
         _max_length = self.max_length if max_ori_len >= self.max_length else max_ori_len
+        if self.pad_to_multiple_of is not None:
+            _max_length = min(
+                -(-_max_length // self.pad_to_multiple_of) * self.pad_to_multiple_of,
+                self.max_length,
+            )
 
         # pad and truncate
         padded_genes = []
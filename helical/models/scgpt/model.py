@@ -1,11 +1,16 @@
+import hashlib
+import json
 import os
 import scanpy as sc
 from helical.models.helical import HelicalBaseModel
 from helical.models.scgpt.scgpt_config import scGPTConfig
 import numpy as np
+import torch
+import anndata as ad
 from anndata import AnnData
 import logging
-from typing import Literal
+from pathlib import Path
+from typing import Literal, Optional, Union
 from accelerate import Accelerator
 from helical.models.scgpt.scgpt_utils import load_model, get_embedding
 from helical.services.downloader import Downloader
@@ -55,36 +60,121 @@ class scGPT(HelicalBaseModel):
             downloader.download_via_name(file)
 
         self.model, self.vocab = load_model(self.config)
+        # building the string to index dict of the vocabulary is costly, it is only done once
+        self._vocab_stoi = dict(self.vocab.get_stoi())
+        if self.config["device"] == "cuda" and self.config["use_tf32"]:
+            # the collator pads the batches to a multiple of 8 up to max_length, so only few input shapes reach cuDNN
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+            torch.backends.cudnn.benchmark = True
+        if self.config["device"] == "cuda" and self.config["embsize"] % 8 != 0:
+            LOGGER.warning(f"The embedding size {self.config['embsize']} is not a multiple of 8, tensor cores will not be used for mixed precision inference.")
         
         if self.config["accelerator"]:
             self.accelerator = Accelerator(project_dir=self.config["model_path"].parent)
             self.model = self.accelerator.prepare(self.model)
         else:
             self.accelerator = None
+
+        if self.config["compile"]:
+            # get_embeddings calls `_encode` directly, which is not covered by compiling the module's forward
+            model = self.accelerator.unwrap_model(self.model) if self.accelerator is not None else self.model
+            model._encode = torch.compile(model._encode, mode=self.config["compile_mode"])
         LOGGER.info(f"Model finished initializing.")
         
-    def get_embeddings(self, data: AnnData) -> np.array:
+    def get_embeddings(self, data: AnnData, output_path: Optional[Union[str, Path]] = None) -> np.array:
         """Gets the gene embeddings
+
+        Parameters
+        ----------
+        data : AnnData
+            The AnnData object returned by `process_data` or `process_data_streaming`.
+        output_path : Union[str, Path], optional, default = None
+            If set, the embeddings are saved to this .npy file and returned as a memory-mapped array.
+            A fingerprint of the cells, the genes and the config is saved next to it, in `<output_path>.json`.
+            If the file already exists and holds float32 embeddings of the expected shape with the same fingerprint, they are loaded without running the model.
+            Otherwise they are recomputed and the file is overwritten. A file at output_path that is not a .npy file raises a ValueError.
         
         Returns
         -------
         np.array
             The gene embeddings in the form of a numpy array
         """
+        if output_path is not None and Path(output_path).exists():
+            embeddings = self._load_embeddings(data, output_path)
+            if embeddings is not None:
+                return embeddings
+
         LOGGER.info(f"Inference started:")
         # The extracted embedding is stored in the `X_scGPT` field of `obsm` in AnnData.
         # for local development, only get embeddings for the first 100 entries
 
+        batch_size = self.config["batch_size"]
+        if self.config["device"] == "cuda" and batch_size % 8 != 0:
+            batch_size = -(-batch_size // 8) * 8
+            LOGGER.warning(f"The batch size {self.config['batch_size']} is not a multiple of 8, using a batch size of {batch_size} instead to make use of tensor cores.")
+
+        # the cell embeddings are computed with `_encode`, which is not exposed by the distributed wrapper
+        model = self.accelerator.unwrap_model(self.model) if self.accelerator is not None else self.model
+
         embeddings = get_embedding(data,
-            model = self.model,
+            model = model,
             vocab = self.vocab,
-            batch_size=self.config["batch_size"],
+            vocab_stoi = self._vocab_stoi,
+            batch_size=batch_size,
             model_configs=self.config,
             gene_col=self.gene_column_name,
-            device=self.config["device"])
+            device=self.config["device"],
+            accelerator=self.accelerator)
+
+        if output_path is not None and (self.accelerator is None or self.accelerator.is_main_process):
+            saved_embeddings = np.lib.format.open_memmap(output_path, mode="w+", dtype=np.float32, shape=embeddings.shape)
+            saved_embeddings[:] = embeddings
+            saved_embeddings.flush()
+            embeddings = saved_embeddings
+            with open(self._get_fingerprint_path(output_path), "w") as f:
+                json.dump({"fingerprint": self._get_fingerprint(data)}, f)
+            LOGGER.info(f"Saved the embeddings to {output_path}.")
         
         return embeddings
     
+    def _get_fingerprint(self, data: AnnData) -> str:
+        """Hashes the cells, the genes and the config that determine the embeddings of the data."""
+        digest = hashlib.sha256()
+        digest.update("\n".join(map(str, data.obs_names)).encode())
+        digest.update("\n".join(map(str, data.var[self.gene_column_name])).encode())
+        digest.update(json.dumps(self.config, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    @staticmethod
+    def _get_fingerprint_path(output_path: Union[str, Path]) -> Path:
+        return Path(f"{output_path}.json")
+
+    def _load_embeddings(self, data: AnnData, output_path: Union[str, Path]) -> Optional[np.memmap]:
+        """Loads the embeddings saved by `get_embeddings` at output_path, or returns None if they do not belong to the data."""
+        try:
+            embeddings = np.load(output_path, mmap_mode="r")
+        except ValueError as e:
+            raise ValueError(f"{output_path} exists but is not a .npy file, it will not be overwritten with the embeddings.") from e
+
+        expected_shape = (data.n_obs, self.config["embsize"])
+        fingerprint_path = self._get_fingerprint_path(output_path)
+        if embeddings.shape != expected_shape:
+            reason = f"have shape {embeddings.shape} instead of {expected_shape}"
+        elif embeddings.dtype != np.float32:
+            reason = f"have dtype {embeddings.dtype} instead of float32"
+        elif not fingerprint_path.exists():
+            reason = f"have no fingerprint in {fingerprint_path}"
+        else:
+            with open(fingerprint_path) as f:
+                fingerprint = json.load(f).get("fingerprint")
+            if fingerprint == self._get_fingerprint(data):
+                LOGGER.info(f"Loaded the embeddings from {output_path}.")
+                return embeddings
+            reason = "were computed for other cells, genes or another config"
+        LOGGER.warning(f"The embeddings in {output_path} {reason}, they will be recomputed.")
+        return None
+
     def process_data(self, 
                      adata: AnnData, 
                      gene_column_name: str = "gene_symbols", 
@@ -128,3 +218,26 @@ class scGPT(HelicalBaseModel):
             sc.pp.highly_variable_genes(self.adata, n_top_genes=n_top_genes, flavor=flavor)
             self.adata = self.adata[:, self.adata.var['highly_variable']]
         return self.adata
+
+    def process_data_streaming(self,
+                               adata_path: Union[str, Path],
+                               gene_column_name: str = "gene_symbols") -> AnnData:
+        """Opens an on-disk .h5ad file for the scGPT model without loading the expression matrix into memory.
+        The AnnData is opened in backed mode and the cells are read from disk batch by batch in `get_embeddings`.
+        
+        Parameters 
+        ----------
+        adata_path : Union[str, Path]
+            The path to the .h5ad file containing the expression counts.
+            As in `process_data`, the column with the gene symbols is defined by the argument gene_column_name.
+        gene_column_name: str, optional, default = "gene_symbols"
+            The name of the column containing the genes in the data.
+
+        Returns
+        -------
+        AnnData
+            The AnnData object in backed mode
+        """
+        self.gene_column_name = gene_column_name
+        self.adata = ad.read_h5ad(adata_path, backed="r")
+        return self.adata
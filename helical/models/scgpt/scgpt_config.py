@@ -38,6 +38,14 @@ class scGPTConfig():
         The device to use. Either use "cuda" or "cpu".
     use_fast_transformer : bool, optional, default = False
         Wheter to use fast transformer or nots
+    precision : Literal["fp32", "fp16", "bf16"], optional, default = "bf16"
+        The precision used for inference on CUDA. "bf16" falls back to "fp16" on GPUs without bfloat16 support.
+    use_tf32 : bool, optional, default = True
+        Whether to allow TF32 matmuls and convolutions and enable the cuDNN autotuner on CUDA.
+    compile : bool, optional, default = False
+        Whether to compile the encoder of the model with `torch.compile`. The first batches are slower while the kernels are compiled.
+    compile_mode : Literal["default", "reduce-overhead", "max-autotune"], optional, default = "reduce-overhead"
+        The `torch.compile` mode, only used if compile is True. "max-autotune" compiles longer but can pay off for large datasets.
 
     Returns
     -------
@@ -67,6 +75,10 @@ class scGPTConfig():
             accelerator: Optional[bool] = False,
             device: Literal["cpu", "cuda"] = "cpu",
             use_fast_transformer: bool = False,
+            precision: Literal["fp32", "fp16", "bf16"] = "bf16",
+            use_tf32: bool = True,
+            compile: bool = False,
+            compile_mode: Literal["default", "reduce-overhead", "max-autotune"] = "reduce-overhead",
             ):
         
         model_name = 'best_model' # TODO: Include more models
@@ -94,4 +106,8 @@ class scGPTConfig():
             "accelerator": accelerator,
             "device": device,
             "use_fast_transformer": use_fast_transformer,
+            "precision": precision,
+            "use_tf32": use_tf32,
+            "compile": compile,
+            "compile_mode": compile_mode,
             }
\ No newline at end of file
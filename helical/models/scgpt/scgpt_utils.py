@@ -70,6 +70,8 @@ def get_embedding(
     obs_to_save: Optional[list] = None,
     device: Union[str, torch.device] = "cuda",
     return_new_adata: bool = False,
+    accelerator = None,
+    vocab_stoi: Optional[dict] = None,
 ) -> AnnData:
     """
     Preprocess anndata and embed the data using the model.
@@ -87,6 +89,10 @@ def get_embedding(
         use_fast_transformer (bool): Whether to use flash-attn. Defaults to True.
         return_new_adata (bool): Whether to return a new AnnData object. If False, will
             add the cell embeddings to a new :attr:`adata.obsm` with key "X_scGPT".
+        accelerator (Accelerator, optional): The accelerator used to shard the inference
+            across processes. Defaults to None.
+        vocab_stoi (dict, optional): The string to index mapping of the vocabulary. If None,
+            it is built from the vocabulary. Defaults to None.
 
     Returns:
         AnnData: The AnnData object with the cell embeddings.
@@ -111,18 +117,22 @@ def get_embedding(
         if not torch.cuda.is_available():
             print("WARNING: CUDA is not available. Using CPU instead.")
 
-    adata.var["id_in_vocab"] = [
-        vocab[gene] if gene in vocab else -1 for gene in adata.var[gene_col]
-    ]
-    gene_ids_in_vocab = np.array(adata.var["id_in_vocab"])
-    adata = adata[:, adata.var["id_in_vocab"] >= 0]
+    if vocab_stoi is None:
+        vocab_stoi = vocab.get_stoi()
+    adata.var["id_in_vocab"] = (
+        adata.var[gene_col].astype(object).map(vocab_stoi).fillna(-1).astype(np.int64).values
+    )
+    gene_ids_in_vocab = adata.var["id_in_vocab"].values
+    if adata.isbacked:
+        # subsetting the genes of a backed AnnData would load the whole matrix into memory,
+        # the genes which are not in the vocabulary are dropped row by row instead
+        gene_ids = gene_ids_in_vocab
+    else:
+        adata = adata[:, gene_ids_in_vocab >= 0]
+        gene_ids = gene_ids_in_vocab[gene_ids_in_vocab >= 0]
 
     # Binning will be applied after tokenization. A possible way to do is to use the unified way of binning in the data collator.
 
-    vocab.set_default_index(vocab["<pad>"])
-    genes = adata.var[gene_col].tolist()
-    gene_ids = np.array(vocab(genes), dtype=int)
-
     # get cell embeddings
     cell_embeddings = get_batch_cell_embeddings(
         adata,
@@ -134,6 +144,7 @@ def get_embedding(
         model_configs=model_configs,
         gene_ids=gene_ids,
         use_batch_labels=False,
+        accelerator=accelerator,
     )
 
     if return_new_adata:
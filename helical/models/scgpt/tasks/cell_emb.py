@@ -1,3 +1,4 @@
+import contextlib
 import json
 import os
 from pathlib import Path
@@ -6,10 +7,13 @@ from typing import Optional, Union
 import numpy as np
 import scanpy as sc
 import torch
+import torch.nn.functional as F
 from anndata import AnnData
+from scipy import sparse
 from torch.utils.data import DataLoader, SequentialSampler
 from tqdm import tqdm
 
+from helical.models.inference_utils import CUDAPrefetcher, get_autocast_dtype
 from .. import logger
 from ..data_collator import DataCollator
 from ..model_dir import TransformerModel
@@ -20,22 +24,45 @@ PathLike = Union[str, os.PathLike]
 
 class Dataset(torch.utils.data.Dataset):
     def __init__(self, count_matrix, gene_ids, vocab, model_configs, batch_ids=None):
+        # sparse matrices are kept as CSR and rows are only gathered in __getitem__
+        if sparse.issparse(count_matrix):
+            count_matrix = sparse.csr_matrix(count_matrix)
         self.count_matrix = count_matrix
         self.gene_ids = gene_ids
         self.batch_ids = batch_ids
         self.vocab = vocab
+        self.cls_token_id = vocab["<cls>"]
         self.model_configs = model_configs
 
     def __len__(self):
-        return len(self.count_matrix)
+        return self.count_matrix.shape[0]
+
+    def _get_nonzero(self, idx):
+        if sparse.issparse(self.count_matrix):
+            start, end = self.count_matrix.indptr[idx], self.count_matrix.indptr[idx + 1]
+            nonzero_idx = self.count_matrix.indices[start:end]
+            values = self.count_matrix.data[start:end]
+        else:
+            # in-memory arrays or the on-disk matrix of a backed AnnData, which is read row by row
+            row = self.count_matrix[idx]
+            if sparse.issparse(row):
+                row = sparse.csr_matrix(row)
+                nonzero_idx, values = row.indices, row.data
+            else:
+                row = np.asarray(row).ravel()
+                nonzero_idx = np.nonzero(row)[0]
+                values = row[nonzero_idx]
+        # drop explicitly stored zeros
+        return nonzero_idx[values != 0], values[values != 0]
 
     def __getitem__(self, idx):
-        row = self.count_matrix[idx]
-        nonzero_idx = np.nonzero(row)[0]
-        values = row[nonzero_idx]
+        nonzero_idx, values = self._get_nonzero(idx)
         genes = self.gene_ids[nonzero_idx]
+        # genes that are not in the vocabulary have a negative id, which only happens for backed data
+        in_vocab = genes >= 0
+        genes, values = genes[in_vocab], values[in_vocab]
         # append <cls> token at the beginning
-        genes = np.insert(genes, 0, self.vocab["<cls>"])
+        genes = np.insert(genes, 0, self.cls_token_id)
         values = np.insert(values, 0, self.model_configs["pad_value"])
         genes = torch.from_numpy(genes).long()
         values = torch.from_numpy(values).float()
@@ -48,6 +75,51 @@ class Dataset(torch.utils.data.Dataset):
             output["batch_labels"] = self.batch_ids[idx]
         return output
 
+def _autocast(device, precision: str = "bf16"):
+    """
+    Get the autocast context for inference with the given precision, see
+    `get_autocast_dtype`.
+    """
+    dtype = get_autocast_dtype(device, precision)
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type="cuda", dtype=dtype)
+
+
+def _iter_on_device(data_loader, device, keys):
+    """
+    Iterate over the data loader and move the tensors under `keys` to `device`.
+
+    On CUDA, the next batch is fetched and copied on a side stream by
+    `CUDAPrefetcher`, so that the copy overlaps with the computation on the
+    current batch.
+    """
+    if device.type == "cuda":
+        return CUDAPrefetcher(data_loader, device, keys)
+    return ({key: data_dict[key].to(device) for key in keys} for data_dict in data_loader)
+
+
+def _write_gathered(cell_embeddings, embeddings, count, accelerator=None) -> int:
+    """
+    Write the embeddings of a batch into the output buffer after the first
+    `count` cells, gathered across the processes if an accelerator is given.
+    Returns the number of cells written so far.
+
+    `gather_for_metrics` can not be used here: `_iter_on_device` fetches one
+    batch ahead, so accelerate flags the end of the dataloader while the
+    second to last batch is processed and would truncate that batch instead.
+    The samples duplicated to even out the last batches across the processes
+    come last, so capping at the number of cells drops exactly those.
+    """
+    if accelerator is not None:
+        embeddings = accelerator.gather(embeddings)
+    num_new_cells = min(len(embeddings), len(cell_embeddings) - count)
+    cell_embeddings[count : count + num_new_cells].copy_(
+        embeddings[:num_new_cells], non_blocking=True
+    )
+    return count + num_new_cells
+
+
 def get_batch_cell_embeddings(
     adata,
     cell_embedding_mode: str = "cls",
@@ -58,6 +130,7 @@ def get_batch_cell_embeddings(
     model_configs=None,
     gene_ids=None,
     use_batch_labels=False,
+    accelerator=None,
 ) -> np.ndarray:
     """
     Get the cell embeddings for a batch of cells.
@@ -72,15 +145,14 @@ def get_batch_cell_embeddings(
         model_configs (dict, optional): The model configurations. Defaults to None.
         gene_ids (np.ndarray, optional): The gene vocabulary ids. Defaults to None.
         use_batch_labels (bool): Whether to use batch labels. Defaults to False.
+        accelerator (Accelerator, optional): If given, the batches are sharded across
+            the processes and the embeddings are gathered in order. Defaults to None.
 
     Returns:
         np.ndarray: The cell embeddings.
     """
 
     count_matrix = adata.X
-    count_matrix = (
-        count_matrix if isinstance(count_matrix, np.ndarray) else count_matrix.A
-    )
 
     # gene vocabulary ids
     if gene_ids is None:
@@ -88,21 +160,25 @@ def get_batch_cell_embeddings(
         assert np.all(gene_ids >= 0)
 
     if use_batch_labels:
-        batch_ids = np.array(adata.obs["batch_id"].tolist())
+        batch_ids = adata.obs["batch_id"].to_numpy()
 
     if cell_embedding_mode == "cls":
+        pad_token_id = vocab[model_configs["pad_token"]]
         dataset = Dataset(
             count_matrix, gene_ids, vocab, model_configs, batch_ids if use_batch_labels else None
         )
         collator = DataCollator(
             do_padding=True,
-            pad_token_id=vocab[model_configs["pad_token"]],
+            pad_token_id=pad_token_id,
             pad_value=model_configs["pad_value"],
             do_mlm=False,
             do_binning=True,
             max_length=max_length,
             sampling=True,
             keep_first_n_tokens=1,
+            # tensor cores are only used if the matmul dimensions are multiples of 8,
+            # the padding is masked and capped at max_length, so the genes seen per cell are unchanged
+            pad_to_multiple_of=8,
         )
         data_loader = DataLoader(
             dataset,
@@ -112,34 +188,41 @@ def get_batch_cell_embeddings(
             drop_last=False,
             pin_memory=True,
         )
+        if accelerator is not None:
+            # each process embeds every world_size-th batch, gathering after each batch keeps the cells in order
+            data_loader = accelerator.prepare(data_loader)
 
         device = next(model.parameters()).device
-        cell_embeddings = np.zeros(
-            (len(dataset), model_configs["embsize"]), dtype=np.float32
+        keys = ["gene", "expr", "batch_labels"] if use_batch_labels else ["gene", "expr"]
+        # pinned memory lets the device to host copies run asynchronously, we only wait for them once after the loop
+        cell_embeddings = torch.empty(
+            (len(dataset), model_configs["embsize"]),
+            dtype=torch.float32,
+            pin_memory=device.type == "cuda",
         )
-        with torch.no_grad(), torch.cuda.amp.autocast(enabled=True): #torch.autocast(device_type=str(device),enabled=True): # torch.cuda.amp.autocast(enabled=True):
+        with torch.no_grad(), _autocast(device, model_configs.get("precision", "bf16")):
             count = 0
-            for data_dict in tqdm(data_loader, desc="Embedding cells"):
-                input_gene_ids = data_dict["gene"].to(device)
-                src_key_padding_mask = input_gene_ids.eq(
-                    vocab[model_configs["pad_token"]]
-                )
+            for data_dict in tqdm(_iter_on_device(data_loader, device, keys),
+                                  total=len(data_loader),
+                                  desc="Embedding cells",
+                                  disable=accelerator is not None and not accelerator.is_local_main_process):
+                input_gene_ids = data_dict["gene"]
+                src_key_padding_mask = input_gene_ids.eq(pad_token_id)
                 embeddings = model._encode(
                     input_gene_ids,
-                    data_dict["expr"].to(device),
+                    data_dict["expr"],
                     src_key_padding_mask=src_key_padding_mask,
-                    batch_labels=data_dict["batch_labels"].to(device)
+                    batch_labels=data_dict["batch_labels"]
                     if use_batch_labels
                     else None,
                 )
 
                 embeddings = embeddings[:, 0, :]  # get the <cls> position embedding
-                embeddings = embeddings.cpu().numpy()
-                cell_embeddings[count : count + len(embeddings)] = embeddings
-                count += len(embeddings)
-        cell_embeddings = cell_embeddings / np.linalg.norm(
-            cell_embeddings, axis=1, keepdims=True
-        )
+                embeddings = F.normalize(embeddings.float(), dim=1)
+                count = _write_gathered(cell_embeddings, embeddings, count, accelerator)
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+        cell_embeddings = cell_embeddings.numpy()
     else:
         raise ValueError(f"Unknown cell embedding mode: {cell_embedding_mode}")
     return cell_embeddings
@@ -210,21 +293,21 @@ def embed_data(
     for s in special_tokens:
         if s not in vocab:
             vocab.append_token(s)
-    adata.var["id_in_vocab"] = [
-        vocab[gene] if gene in vocab else -1 for gene in adata.var[gene_col]
-    ]
-    gene_ids_in_vocab = np.array(adata.var["id_in_vocab"])
+    vocab_stoi = vocab.get_stoi()
+    adata.var["id_in_vocab"] = (
+        adata.var[gene_col].astype(object).map(vocab_stoi).fillna(-1).astype(np.int64).values
+    )
+    gene_ids_in_vocab = adata.var["id_in_vocab"].values
     logger.info(
         f"match {np.sum(gene_ids_in_vocab >= 0)}/{len(gene_ids_in_vocab)} genes "
         f"in vocabulary of size {len(vocab)}."
     )
-    adata = adata[:, adata.var["id_in_vocab"] >= 0]
+    adata = adata[:, gene_ids_in_vocab >= 0]
 
     # Binning will be applied after tokenization. A possible way to do is to use the unified way of binning in the data collator.
 
     vocab.set_default_index(vocab["<pad>"])
-    genes = adata.var[gene_col].tolist()
-    gene_ids = np.array(vocab(genes), dtype=int)
+    gene_ids = gene_ids_in_vocab[gene_ids_in_vocab >= 0]
 
     # all_counts = adata.layers["counts"]
     # num_of_non_zero_genes = [
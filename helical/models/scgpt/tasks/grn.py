@@ -132,7 +132,7 @@ class GeneEmbedding(object):
         for p, genes in metagenes.items():
             try:
                 sc.tl.score_genes(adata, score_name=str(p) + "_SCORE", gene_list=genes)
-                scores = np.array(adata.obs[str(p) + "_SCORE"].tolist()).reshape(-1, 1)
+                scores = adata.obs[str(p) + "_SCORE"].to_numpy().reshape(-1, 1)
                 scaler = MinMaxScaler()
                 scores = scaler.fit_transform(scores)
                 scores = list(scores.reshape(1, -1))[0]
@@ -18,7 +18,7 @@ from helical.models.scgpt.loss import (
 from helical.models.scgpt.utils import eval_scib_metrics
 import warnings
 from scipy.sparse import issparse
-from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score
+from sklearn.metrics import accuracy_score, precision_recall_fscore_support, f1_score
 
 
 def prepare_data(
@@ -565,9 +565,10 @@ def test(
 
     # compute accuracy, precision, recall, f1
     accuracy = accuracy_score(celltypes_labels, predictions)
-    precision = precision_score(celltypes_labels, predictions, average="macro")
-    recall = recall_score(celltypes_labels, predictions, average="macro")
-    macro_f1 = f1_score(celltypes_labels, predictions, average="macro")
+    # a single pass over the confusion matrix for all the macro averaged metrics
+    precision, recall, macro_f1, _ = precision_recall_fscore_support(
+        celltypes_labels, predictions, average="macro"
+    )
     micro_f1 = f1_score(celltypes_labels, predictions, average="micro")
 
     logger.info(
@@ -53,12 +53,13 @@ def load_gene_embeddings_adata(adata: AnnData, species: list, embedding_model: s
     if not (species_names_set <= available_species):
         logger.error(f'Missing gene embeddings here: {embeddings_path}')
         raise ValueError(f'The following species do not have gene embeddings: {species_names_set - available_species}')
-    # Load gene embeddings for desired species (and convert gene symbols to lower case)
-    species_to_gene_symbol_to_embedding = {
-        species: {
-            gene_symbol.lower(): gene_embedding
-            for gene_symbol, gene_embedding in torch.load(species_to_gene_embedding_path[species]).items()
-        }
+    # Load gene symbols for desired species (converted to lower case), the embeddings themselves are not needed here
+    # and each file is only loaded once
+    species_to_all_gene_symbols = {
+        species: [
+            gene_symbol.lower()
+            for gene_symbol in torch.load(species_to_gene_embedding_path[species]).keys()
+        ]
         for species in species_names
     }
 
@@ -66,22 +67,13 @@ def load_gene_embeddings_adata(adata: AnnData, species: list, embedding_model: s
 
     # Determine which genes to include based on gene expression and embedding availability
     genes_with_embeddings = set.intersection(*[
-        set(gene_symbol_to_embedding)
-        for gene_symbol_to_embedding in species_to_gene_symbol_to_embedding.values()
+        set(gene_symbols)
+        for gene_symbols in species_to_all_gene_symbols.values()
     ])
-    genes_to_use = {gene for gene in adata.var_names if gene.lower() in genes_with_embeddings}
     
-    # Subset data to only use genes with embeddings
-    filtered_adata = adata[:, adata.var_names.isin(genes_to_use)]
+    # Subset data to only use genes with embeddings, with a vectorized mask instead of per-gene lookups
+    filtered_adata = adata[:, adata.var_names.str.lower().isin(list(genes_with_embeddings))]
     filtered = adata.var_names.shape[0] - filtered_adata.var_names.shape[0]
     logger.info(f'Filtered out {filtered} genes to a total of {filtered_adata.var_names.shape[0]} genes with embeddings.')
 
-    # Load gene symbols for desired species for later use with indexes
-    species_to_all_gene_symbols = {
-        species: [
-            gene_symbol.lower()
-            for gene_symbol, _ in torch.load(species_to_gene_embedding_path[species]).items()
-        ]
-        for species in species_names
-    }
     return filtered_adata, species_to_all_gene_symbols
@@ -1,10 +1,12 @@
 import logging
 import numpy as np
+import torch
 from anndata import AnnData
 from torch.utils.data import DataLoader
 from helical.models.uce.uce_config import UCEConfig
 from helical.models.helical import HelicalBaseModel
-from helical.models.uce.uce_utils import get_ESM2_embeddings, load_model, process_data, get_gene_embeddings
+from helical.models.inference_utils import get_autocast_dtype
+from helical.models.uce.uce_utils import get_ESM2_embeddings, load_model, process_data, get_gene_embeddings, embed_and_normalize, tune_batch_size, get_dataloader
 from accelerate import Accelerator
 from helical.services.downloader import Downloader
 
@@ -48,22 +50,43 @@ class UCE(HelicalBaseModel):
             downloader.download_via_name(file)
 
         self.model_dir = self.config['model_path'].parent
+        # the files are fixed per model, process_data reuses them on every call
+        self.files_config = {
+            "spec_chrom_csv_path": self.model_dir / "species_chrom.csv",
+            "protein_embeddings_dir": self.model_dir / "protein_embeddings/",
+            "offset_pkl_path": self.model_dir / "species_offsets.pkl"
+        }
         self.device = self.config["device"]
         self.embeddings = get_ESM2_embeddings(self.config["token_file_path"], self.config["token_dim"])
-        self.model =  load_model(self.config['model_path'], self.config, self.embeddings)
-        self.model = self.model.eval().to(self.device)
+        self.model =  load_model(self.config['model_path'], self.config, self.embeddings, self.device)
+        self.model = self.model.eval()
+
+        self.autocast_dtype = get_autocast_dtype(self.device, self.config["precision"])
+        if self.autocast_dtype is not None:
+            # the embedding lookup is a pure gather, storing the table in half precision halves its memory traffic
+            self.model.pe_embedding.to(self.autocast_dtype)
 
         if self.config["accelerator"] or self.device=='cuda':
             self.accelerator = Accelerator(project_dir=self.model_dir)#, cpu=self.config["accelerator"]["cpu"])
             self.model = self.accelerator.prepare(self.model)
         else:
             self.accelerator = None
+
+        # resolved once instead of on every batch
+        self._pe_embedding = self.model.module.pe_embedding if self.config["multi_gpu"] else self.model.pe_embedding
+        self.embed_fn = embed_and_normalize
+        if self.config["compile"]:
+            self.embed_fn = torch.compile(embed_and_normalize, mode=self.config["compile_mode"])
+        self._tuned_batch_size = None
+        # the last DataLoader passed to get_embeddings and the one rebuilt from it with the tuned batch size
+        self._tuned_dataloaders = (None, None)
         LOGGER.info(f"Model finished initializing.")
 
     def process_data(self, data: AnnData, 
                      species: str = "human", 
                      filter_genes_min_cell: int = None, 
-                     embedding_model: str = "ESM2" ) -> DataLoader:
+                     embedding_model: str = "ESM2",
+                     in_memory: bool = False) -> DataLoader:
         """Processes the data for the Universal Cell Embedding model
 
         Parameters 
@@ -74,31 +97,44 @@ class UCE(HelicalBaseModel):
         species: str, optional, default = "human"
             The species of the data.  Currently we support "human" and "macaca_fascicularis" but more embeddings will come soon.
         filter_genes_min_cell: int, default = None
-            Filter threshold that defines how many times a gene should occur in all the cells.
+            Filter threshold that defines how many times a gene should occur in all the cells. The data passed in is not modified by the filtering.
         embedding_model: str, optional, default = "ESM2"
             The name of the gene embedding model. The current option is only ESM2.
+        in_memory: bool, optional, default = False
+            If True, the expression counts are handed to the dataset directly instead of being written to a memory-mapped file on disk. 
+            This is faster if the data fits in memory.
 
         Returns
         -------
         DataLoader
             The DataLoader object containing the processed data
         """
-        
-        files_config = {
-            "spec_chrom_csv_path": self.model_dir / "species_chrom.csv",
-            "protein_embeddings_dir": self.model_dir / "protein_embeddings/",
-            "offset_pkl_path": self.model_dir / "species_offsets.pkl"
-        }
 
         data_loader = process_data(data, 
                               model_config=self.config, 
-                              files_config=files_config,
+                              files_config=self.files_config,
                               species=species,
                               filter_genes_min_cell=filter_genes_min_cell,
                               embedding_model=embedding_model,
-                              accelerator=self.accelerator)
+                              accelerator=self.accelerator,
+                              in_memory=in_memory)
         return data_loader
 
+    def _get_tuned_dataloader(self, dataloader: DataLoader) -> DataLoader:
+        """Rebuilds the DataLoader with the tuned batch size, once per DataLoader passed in.
+        The rebuilt DataLoader is reused on the next calls, so that it is not prepared by the accelerator again.
+        """
+        source, tuned_dataloader = self._tuned_dataloaders
+        if dataloader is source:
+            return tuned_dataloader
+        # the DataLoader prepared by accelerate has no batch_size, its batch sampler keeps it
+        batch_size = dataloader.batch_size if dataloader.batch_size is not None else dataloader.batch_sampler.batch_size
+        if batch_size == self._tuned_batch_size:
+            return dataloader
+        tuned_dataloader = get_dataloader(dataloader.dataset, self.config, self._tuned_batch_size, self.accelerator)
+        self._tuned_dataloaders = (dataloader, tuned_dataloader)
+        return tuned_dataloader
+
     def get_embeddings(self, dataloader: DataLoader) -> np.array:
         """Gets the gene embeddings from the UCE model
 
@@ -112,6 +148,19 @@ class UCE(HelicalBaseModel):
         np.array
             The gene embeddings in the form of a numpy array
         """
+        if self.config["auto_batch_size"] and self.device == "cuda":
+            if self._tuned_batch_size is None:
+                self._tuned_batch_size = tune_batch_size(self.model, self._pe_embedding, self.config, self.autocast_dtype, self.embed_fn)
+                LOGGER.info(f"Setting batch_size={self._tuned_batch_size} for inference, the largest batch size that fits in the GPU memory.")
+            dataloader = self._get_tuned_dataloader(dataloader)
+
         LOGGER.info(f"Inference started")
-        embeddings = get_gene_embeddings(self.model, dataloader, self.accelerator)
+        embeddings = get_gene_embeddings(self.model, 
+                                         dataloader, 
+                                         self.accelerator, 
+                                         autocast_dtype=self.autocast_dtype, 
+                                         preload_to_device=self.config["preload_to_device"],
+                                         embed_fn=self.embed_fn,
+                                         pe_embedding=self._pe_embedding,
+                                         use_cuda_graph=self.config["use_cuda_graph"])
         return embeddings
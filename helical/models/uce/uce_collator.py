@@ -7,7 +7,10 @@ class UCECollator(object):
 
     def __call__(self, batch):
         batch_size = len(batch)
-        batch_sentences = torch.zeros((batch_size, self.pad_length))
+        # the batch sentences are built as (seq_len, batch_size), the layout the model expects,
+        # so that the slice to max_len below stays contiguous and no permute is needed before the embedding lookup.
+        # They are token indices, int64 is the dtype the embedding lookup takes, so no cast is needed there either
+        batch_sentences = torch.zeros((self.pad_length, batch_size), dtype=torch.int64)
         mask = torch.zeros((batch_size, self.pad_length))
         cell_sentences = torch.zeros((batch_size, self.pad_length))
 
@@ -16,7 +19,7 @@ class UCECollator(object):
         i = 0
         max_len = 0
         for bs, msk, idx, seq_len, cs in batch:
-            batch_sentences[i, :] = bs
+            batch_sentences[:, i] = bs.view(-1)
             cell_sentences[i, :] = cs
             max_len = max(max_len, seq_len)
             mask[i, :] = msk
@@ -24,5 +27,5 @@ class UCECollator(object):
 
             i += 1
 
-        return batch_sentences[:, :max_len] , mask[:, :max_len], idxs, cell_sentences
+        return batch_sentences[:max_len] , mask[:, :max_len], idxs, cell_sentences
     
\ No newline at end of file
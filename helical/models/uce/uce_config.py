@@ -41,6 +41,27 @@ class UCEConfig():
         The device to use. Either use "cuda" or "cpu".
     accelerator : bool, optional, default = False
         The accelerator configuration. By default same device as model.
+    num_workers : int, optional, default = 0
+        The number of worker processes used by the DataLoader to sample the cell sentences. By default they are sampled in the main process. 
+        The workers are seeded from the global numpy random state, so the sampling stays reproducible with `np.random.seed`, 
+        but for a given seed the embeddings differ between numbers of workers. With `in_memory=True` in process_data, each worker holds a copy of the expression matrix.
+    preload_to_device : bool, optional, default = False
+        Whether to copy all the batches to the GPU before the inference, if they fit in half of the free GPU memory.
+        This removes the host to device copies from the inference loop, which helps for small datasets.
+    precision : Literal["fp32", "fp16", "bf16"], optional, default = "bf16"
+        The precision of the UCE inference on CUDA, on CPU it always runs in "fp32". The protein embedding table is cast to that dtype and the transformer runs under autocast. 
+        GPUs older than Ampere have no bfloat16, "fp16" is used there instead of "bf16".
+    auto_batch_size : bool, optional, default = False
+        Whether to replace the batch size on CUDA by the largest power of two that fits in the GPU memory (minus a 10% margin). 
+        It is probed once with dummy batches of length pad_length, on the first call to get_embeddings.
+    use_cuda_graph : bool, optional, default = False
+        Whether to capture the inference of the batches in CUDA graphs and replay them for the following batches of the same shape, which removes the kernel launch overhead. 
+        A graph is captured for each of the first 16 batch shapes, batches of other shapes run without a graph.
+    compile : bool, optional, default = False
+        Whether to compile the protein embedding lookup and its normalization with `torch.compile`, which fuses them into a single kernel. 
+        Compiling happens on the first get_embeddings call and takes a while, which pays off for large datasets only.
+    compile_mode : Literal["default", "reduce-overhead", "max-autotune"], optional, default = "reduce-overhead"
+        The `torch.compile` mode, only used if compile is True.
 
     Returns
     -------
@@ -63,7 +84,14 @@ class UCEConfig():
                  token_dim: int = 5120,
                  multi_gpu: bool = False,
                  device: Literal["cpu", "cuda"] = "cpu",
-                 accelerator: Optional[bool] = False
+                 accelerator: Optional[bool] = False,
+                 num_workers: int = 0,
+                 preload_to_device: bool = False,
+                 precision: Literal["fp32", "fp16", "bf16"] = "bf16",
+                 auto_batch_size: bool = False,
+                 use_cuda_graph: bool = False,
+                 compile: bool = False,
+                 compile_mode: Literal["default", "reduce-overhead", "max-autotune"] = "reduce-overhead"
                 ):
         
         # model specific parameters
@@ -109,4 +137,11 @@ class UCEConfig():
             "multi_gpu": multi_gpu,
             "device": device,
             "accelerator": accelerator,
+            "num_workers": num_workers,
+            "preload_to_device": preload_to_device,
+            "precision": precision,
+            "auto_batch_size": auto_batch_size,
+            "use_cuda_graph": use_cuda_graph,
+            "compile": compile,
+            "compile_mode": compile_mode,
         }
\ No newline at end of file
@@ -0,0 +1,64 @@
+import logging
+import torch
+
+LOGGER = logging.getLogger(__name__)
+
+class CUDAGraphForward(object):
+    '''
+    Wraps the inference function of a batch and replays it from CUDA graphs, which removes the kernel launch overhead of every batch.
+    A graph is captured for each new (seq_len, batch_size) shape of the batches, the batches are not padded any further:
+    the UCE model passes its mask as a float padding mask, which is added to the attention logits, so extra padding would change the embeddings.
+    The graphs share one memory pool, which is safe as they are never replayed concurrently and their static inputs and outputs stay allocated.
+    Once max_graphs graphs are captured, batches of new shapes run eagerly, as does everything if a capture fails.
+
+    Args:
+        fn: The function to replay, taking the batch sentences of shape (seq_len, batch_size) and the mask of shape (batch_size, seq_len)
+        max_graphs: The maximum number of graphs captured
+        num_warmup: The number of eager calls made before each capture
+    '''
+    def __init__(self, fn, max_graphs=16, num_warmup=2):
+        self.fn = fn
+        self.max_graphs = max_graphs
+        self.num_warmup = num_warmup
+        self.graphs = {}
+        self.pool = None
+        self.capture_failed = False
+
+    def capture(self, batch_sentences, mask):
+        static_sentences = batch_sentences.clone()
+        static_mask = mask.clone()
+        device = batch_sentences.device
+
+        # the warm up runs on a side stream, so that the capture does not record the lazy initializations
+        stream = torch.cuda.Stream(device=device)
+        stream.wait_stream(torch.cuda.current_stream(device))
+        with torch.cuda.stream(stream):
+            for _ in range(self.num_warmup):
+                self.fn(static_sentences, static_mask)
+        torch.cuda.current_stream(device).wait_stream(stream)
+
+        if self.pool is None:
+            self.pool = torch.cuda.graph_pool_handle()
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph, pool=self.pool):
+            static_output = self.fn(static_sentences, static_mask)
+        return graph, static_sentences, static_mask, static_output
+
+    def __call__(self, batch_sentences, mask):
+        shape = tuple(batch_sentences.shape)
+        if shape not in self.graphs:
+            if self.capture_failed or len(self.graphs) >= self.max_graphs:
+                return self.fn(batch_sentences, mask)
+            try:
+                self.graphs[shape] = self.capture(batch_sentences, mask)
+            except RuntimeError as e:
+                LOGGER.warning(f"Capturing the CUDA graph failed, running the inference eagerly: {e}")
+                self.capture_failed = True
+                return self.fn(batch_sentences, mask)
+
+        graph, static_sentences, static_mask, static_output = self.graphs[shape]
+        static_sentences.copy_(batch_sentences)
+        static_mask.copy_(mask)
+        graph.replay()
+        # the static output is overwritten by the next replay of this graph
+        return static_output.clone()
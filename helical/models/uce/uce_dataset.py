@@ -1,6 +1,7 @@
 from helical.models.uce.uce_collator import UCECollator
 from torch.utils.data import Dataset
 import numpy as np
+import scipy.sparse
 import torch
 from typing import Dict
 
@@ -12,9 +13,11 @@ class UCEDataset(Dataset):
                  dataset_to_protein_embeddings,
                  datasets_to_chroms,
                  datasets_to_starts,
-                 expression_counts_path) -> None:
+                 expression_counts_path,
+                 expression_counts = None) -> None:
         super(UCEDataset, self).__init__()
-        # self.xs = {}
+        # the expression counts per dataset, either given in memory or memory-mapped from the counts files on first access
+        self.xs = dict(expression_counts) if expression_counts is not None else {}
         self.num_cells = {}
         self.num_genes = {}
         self.shapes_dict = shapes_dict
@@ -24,7 +27,6 @@ class UCEDataset(Dataset):
         self.total_num_cells = 0
         for name in sorted_dataset_names:
             num_cells, num_genes = self.shapes_dict[name]
-            # self.xs[name] = X
             self.num_cells[name] = num_cells
             self.num_genes[name] = num_genes
 
@@ -42,8 +44,8 @@ class UCEDataset(Dataset):
         if isinstance(idx, int):
             for dataset in sorted(self.datasets):
                 if idx < self.num_cells[dataset]:
-                    cts = np.memmap(self.npzs_dir + f"{dataset}_counts.npz", dtype='int64', mode='r', shape=self.shapes_dict[dataset])
-                    counts = cts[idx]
+                    counts = self.get_counts(dataset)[idx]
+                    counts = counts.toarray().ravel() if scipy.sparse.issparse(counts) else counts
                     counts = torch.tensor(counts).unsqueeze(0)
                     weights = torch.log1p(counts)
                     weights = (weights / torch.sum(weights))
@@ -56,6 +58,18 @@ class UCEDataset(Dataset):
         else:
             raise NotImplementedError
 
+    def get_counts(self, dataset: str):
+        if dataset not in self.xs:
+            # rows are paged in from disk on access
+            self.xs[dataset] = np.memmap(self.npzs_dir + f"{dataset}_counts.npz", dtype='float32', mode='r', shape=self.shapes_dict[dataset])
+        return self.xs[dataset]
+
+    def __getstate__(self):
+        # a memory map would be pickled as a full in-memory copy, the DataLoader workers open their own instead
+        state = self.__dict__.copy()
+        state["xs"] = {name: x for name, x in self.xs.items() if not isinstance(x, np.memmap)}
+        return state
+
     def __len__(self) -> int:
         return self.total_num_cells
 
@@ -65,15 +79,16 @@ class UCEDataset(Dataset):
     def sample_cell_sentences(self,counts, batch_weights):
 
         dataset_idxs = self.dataset_to_protein_embeddings # get the dataset specific protein embedding idxs
-        cell_sentences = torch.zeros((counts.shape[0], self.config["pad_length"])) # init the cell representation as 0s
-        mask = torch.zeros((counts.shape[0], self.config["pad_length"])) # start of masking the whole sequence
+        # filled as numpy arrays and wrapped with torch.from_numpy at the end, without copying them into new tensors
+        cell_sentences = np.zeros((counts.shape[0], self.config["pad_length"]), dtype=np.int64) # init the cell representation as 0s
+        mask = np.zeros((counts.shape[0], self.config["pad_length"]), dtype=np.float32) # start of masking the whole sequence
         chroms = self.dataset_to_chroms # get the dataset specific chroms for each gene
         starts = self.dataset_to_starts # get the dataset specific genomic start locations for each gene
 
         longest_seq_len = 0 # we need to keep track of this so we can subset the batch at the end
         for c, cell in enumerate(counts):
             weights = batch_weights[c].numpy()
-            weights = weights / sum(weights)  # RE NORM after mask
+            weights = weights / weights.sum()  # RE NORM after mask
             
             # randomly choose the genes that will make up the sample, weighted by expression, with replacement
             choice_idx = np.random.choice(np.arange(len(weights)),
@@ -114,17 +129,13 @@ class UCEDataset(Dataset):
                 i += 1  # add the closing token again
 
             longest_seq_len = max(longest_seq_len, i)
-            remainder_len = (self.config["pad_length"] - i)
-
-            cell_mask = torch.concat((torch.ones(i),
-                                    # pay attention to all of these tokens, ignore the rest!
-                                    torch.zeros(remainder_len)))
 
-            mask[c, :] = cell_mask
+            # pay attention to all of these tokens, ignore the rest!
+            mask[c, :i] = 1
 
             ordered_choice_idx[i:] = self.config["pad_token_idx"] # the remainder of the sequence
-            cell_sentences[c, :] = torch.from_numpy(ordered_choice_idx)
+            cell_sentences[c, :] = ordered_choice_idx
             
-        cell_sentences_pe = cell_sentences.long() # token indices
+        cell_sentences = torch.from_numpy(cell_sentences) # token indices
         
-        return cell_sentences_pe, mask, longest_seq_len, cell_sentences
+        return cell_sentences, torch.from_numpy(mask), longest_seq_len, cell_sentences
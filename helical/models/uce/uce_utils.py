@@ -1,3 +1,4 @@
+import contextlib
 import scanpy as sc
 import torch
 from torch.utils.data import DataLoader
@@ -7,12 +8,15 @@ import numpy as np
 from tqdm import tqdm
 import scipy
 from pathlib import Path
-from typing import Dict, Tuple, Union
+from typing import Dict, Optional, Tuple, Union
 import logging
+from functools import lru_cache
 
 from helical.models.uce.gene_embeddings import load_gene_embeddings_adata
 from helical.models.uce.uce_model import TransformerModel
 from helical.models.uce.uce_dataset import UCEDataset
+from helical.models.inference_utils import CUDAPrefetcher
+from helical.models.uce.uce_cuda_graph import CUDAGraphForward
 
 LOGGER = logging.getLogger(__name__)
 
@@ -22,11 +26,12 @@ def process_data(anndata,
                  species: str, 
                  filter_genes_min_cell: int, 
                  embedding_model: str,
-                 accelerator=None) -> DataLoader:
+                 accelerator=None,
+                 in_memory: bool = False) -> DataLoader:
         
         
         if filter_genes_min_cell is not None:
-            sc.pp.filter_genes(anndata, min_cells=filter_genes_min_cell)
+            anndata = filter_genes(anndata, filter_genes_min_cell)
             # sc.pp.filter_cells(ad, min_genes=25)
         ##Filtering out the Expression Data That we do not have in the protein embeddings
         filtered_adata, species_to_all_gene_symbols = load_gene_embeddings_adata(adata=anndata,
@@ -35,18 +40,18 @@ def process_data(anndata,
                                                                         embeddings_path=Path(files_config["protein_embeddings_dir"]))
         
         # TODO: What about hv_genes? See orig.
-        if scipy.sparse.issparse(filtered_adata.X):
-            gene_expression = np.asarray(filtered_adata.X.todense())
-        else:
-            gene_expression = np.asarray(filtered_adata.X)
-
         name = "test"
         gene_expression_folder_path = "./"
-        prepare_expression_counts_file(gene_expression, name, gene_expression_folder_path)
+        # filtered_adata is a view, its expression matrix is only materialized once here
+        gene_expression = filtered_adata.X
+        if in_memory:
+            expression_counts = {name: gene_expression}
+        else:
+            prepare_expression_counts_file(gene_expression, name, gene_expression_folder_path)
+            expression_counts = None
         
         # shapes dictionary
-        num_cells = filtered_adata.X.shape[0]
-        num_genes = filtered_adata.X.shape[1]
+        num_cells, num_genes = gene_expression.shape
         shapes_dict = {name: (num_cells, num_genes)}
 
         pe_row_idxs = get_protein_embeddings_idxs(files_config["offset_pkl_path"], species, species_to_all_gene_symbols, filtered_adata)
@@ -66,22 +71,77 @@ def process_data(anndata,
                              expression_counts_path = gene_expression_folder_path,
                              dataset_to_protein_embeddings = pe_row_idxs,
                              datasets_to_chroms = dataset_chroms,
-                             datasets_to_starts = dataset_start
+                             datasets_to_starts = dataset_start,
+                             expression_counts = expression_counts
                              )
         batch_size = model_config["batch_size"]
-        dataloader = DataLoader(dataset, 
-                                batch_size=batch_size, 
-                                shuffle=False,
-                                collate_fn=dataset.collator_fn,
-                                num_workers=0)
+        dataloader = get_dataloader(dataset, model_config, batch_size, accelerator)
         
         LOGGER.info(f'UCE Dataset and DataLoader prepared. Setting batch_size={batch_size} for inference.')
 
-        if accelerator is not None:
-            dataloader = accelerator.prepare(dataloader)
-
         return dataloader
 
+def filter_genes(adata: sc.AnnData, min_cells: int) -> sc.AnnData:
+    '''
+    Keep the genes expressed in at least min_cells cells, counting the cells with a positive expression as `sc.pp.filter_genes` does.
+    Unlike scanpy, the AnnData passed in is not modified, for dense and sparse expression matrices alike.
+
+    Args:
+        adata: The AnnData object to filter
+        min_cells: The minimum number of cells a gene has to be expressed in
+
+    Returns:
+        A view of adata with the kept genes.
+    '''
+    X = adata.X
+    if scipy.sparse.issparse(X) and X.format == "csr":
+        # counting the positive entries per column directly on the CSR arrays avoids converting the matrix
+        cells_per_gene = np.bincount(X.indices[X.data > 0], minlength=X.shape[1])
+    else:
+        cells_per_gene = np.asarray((X > 0).sum(axis=0)).ravel()
+    return adata[:, cells_per_gene >= min_cells]
+
+def get_dataloader(dataset: UCEDataset, model_config: Dict[str, str], batch_size: int, accelerator=None) -> DataLoader:
+    '''
+    Build the DataLoader for inference over the UCEDataset.
+
+    Args:
+        dataset: The UCEDataset with the processed data
+        model_config: The model configuration, with 'num_workers', 'device' and 'preload_to_device' as keys
+        batch_size: The batch size
+        accelerator: The accelerator preparing the DataLoader, if any
+
+    Returns:
+        The DataLoader.
+    '''
+    num_workers = model_config["num_workers"]
+    generator = None
+    if num_workers > 0:
+        # the base seed of the workers is drawn from the global numpy random state, so np.random.seed still controls the sampling
+        generator = torch.Generator()
+        generator.manual_seed(int(np.random.randint(2**31)))
+    # pinned batches can be copied to the GPU asynchronously, while the workers sample the next cells
+    dataloader = DataLoader(dataset, 
+                            batch_size=batch_size, 
+                            shuffle=False,
+                            collate_fn=dataset.collator_fn,
+                            num_workers=num_workers,
+                            worker_init_fn=_seed_worker if num_workers > 0 else None,
+                            generator=generator,
+                            # the preloaded batches are copied once, pinning them would only cost an extra copy
+                            pin_memory=model_config["device"] == "cuda" and not model_config["preload_to_device"],
+                            persistent_workers=num_workers > 0,
+                            prefetch_factor=2 if num_workers > 0 else None)
+
+    if accelerator is not None:
+        dataloader = accelerator.prepare(dataloader)
+
+    return dataloader
+
+def _seed_worker(worker_id: int) -> None:
+    # the cell sentences are sampled with numpy, which the DataLoader does not seed in the workers
+    np.random.seed(torch.initial_seed() % 2**32)
+
 def get_positions(species_chrom_csv_path: Path, species: str, adata: sc.AnnData) -> Tuple[pd.Series, np.array]:
     '''
     Get the chromosomes to which the genes in adata belong (encoded with cat.codes) and the start positions of the genes
@@ -98,7 +158,7 @@ def get_positions(species_chrom_csv_path: Path, species: str, adata: sc.AnnData)
     genes_to_chroms_pos["spec_chrom"] = pd.Categorical(genes_to_chroms_pos["species"] + "_" +  genes_to_chroms_pos["chromosome"]) # add the spec_chrom list
     spec_gene_chrom_pos = genes_to_chroms_pos[genes_to_chroms_pos["species"] == species].set_index("gene_symbol")
     
-    filtered_spec_gene_chrom_pos = spec_gene_chrom_pos.loc[[k.upper() for k in adata.var_names]]
+    filtered_spec_gene_chrom_pos = spec_gene_chrom_pos.loc[adata.var_names.str.upper()]
     dataset_chroms = filtered_spec_gene_chrom_pos["spec_chrom"].cat.codes
     dataset_start = filtered_spec_gene_chrom_pos["start"].values
     
@@ -107,6 +167,7 @@ def get_positions(species_chrom_csv_path: Path, species: str, adata: sc.AnnData)
 def get_ESM2_embeddings(token_file: Union[Path, str], token_dim: int) -> torch.Tensor:
     '''
     Loads the token file specified in the config file.
+    The result is cached, repeated calls with the same arguments return the same tensor, which must not be modified.
 
     Args:
         files_config: A dictionary with 'token_file' and 'token_dim' as keys. 
@@ -114,6 +175,11 @@ def get_ESM2_embeddings(token_file: Union[Path, str], token_dim: int) -> torch.T
     Returns:
         The token file loaded as a torch.Tensor.
     '''
+    return _load_ESM2_embeddings(str(token_file), token_dim)
+
+# as for the checkpoint, the cached table is never used as a parameter of a model, load_model copies it
+@lru_cache(maxsize=4)
+def _load_ESM2_embeddings(token_file: str, token_dim: int) -> torch.Tensor:
 
     all_pe = torch.load(token_file)
 
@@ -146,33 +212,45 @@ def get_protein_embeddings_idxs(offset_pkl_path: str, species: str, species_to_a
         species_to_offsets = pickle.load(f)
     offset = species_to_offsets[species]
     spec_all_genes = species_to_all_gene_symbols[species]
-    return torch.tensor([spec_all_genes.index(k.lower()) + offset for k in adata.var_names]).long()
+    # a single dict build instead of a linear list.index() search per gene, keeping the first index of a symbol as list.index() did
+    gene_symbol_to_idx = {}
+    for idx, gene_symbol in enumerate(spec_all_genes):
+        gene_symbol_to_idx.setdefault(gene_symbol, idx)
+    pe_row_idxs = adata.var_names.str.lower().map(gene_symbol_to_idx).to_numpy(dtype=np.int64)
+    return torch.from_numpy(pe_row_idxs + offset)
 
-def prepare_expression_counts_file(gene_expression: np.array, name: str, folder_path: str = "./") -> None:
+def prepare_expression_counts_file(gene_expression: Union[np.array, scipy.sparse.spmatrix], name: str, folder_path: str = "./", chunk_size: int = 4096) -> None:
     '''
     Creates a .npz file and writes the contents of the expression array into this file. 
     This allows handling arrays that are too large to fit entirely in memory. 
     The array is stored on disk, but it can be accessed and manipulated like a regular in-memory array. 
     Changes made to the array are written directly to disk.
+    Sparse matrices are densified and written `chunk_size` rows at a time, so the full dense matrix is never held in memory.
 
     Args:
-        expression: The array to write to the file
+        expression: The dense or sparse array to write to the file
         name: The prefix of the file eventually called {name}_counts.npz
         folder_path: The folder path of the npz file
+        chunk_size: The number of rows written at once
     '''
     filename = folder_path + f"{name}_counts.npz"
     try:
         shape = gene_expression.shape
-        fp = np.memmap(filename, dtype='int64', mode='w+', shape=shape)
-        fp[:] = gene_expression[:]
+        fp = np.memmap(filename, dtype='float32', mode='w+', shape=shape)
+        max_count = 0
+        for start in range(0, shape[0], chunk_size):
+            chunk = gene_expression[start:start + chunk_size]
+            chunk = chunk.toarray() if scipy.sparse.issparse(chunk) else np.asarray(chunk)
+            fp[start:start + chunk_size] = chunk
+            max_count = max(max_count, chunk.max(initial=0))
         fp.flush()
-        LOGGER.info(f"Passed the gene expressions (with shape={shape} and max gene count data {gene_expression.max()}) to {filename}")
+        LOGGER.info(f"Passed the gene expressions (with shape={shape} and max gene count data {max_count}) to {filename}")
     except:
         LOGGER.error(f"Error during preparation of npz file {filename}.")
         raise Exception
     
 ## writing a funciton to load the model 
-def load_model(model_path: Union[str, Path], model_config: Dict[str, str], all_pe: torch.Tensor) -> TransformerModel:
+def load_model(model_path: Union[str, Path], model_config: Dict[str, str], all_pe: torch.Tensor, device: str = "cpu") -> TransformerModel:
     '''
     Load the UCE Transformer Model based on configurations from the model_config file.
 
@@ -180,23 +258,27 @@ def load_model(model_path: Union[str, Path], model_config: Dict[str, str], all_p
         model_path: A path to the model to load
         model_config: A dictionary with 'token_dim', 'd_hid', 'n_layers' and 'output_dim' as keys. 
         all_pe: The token file loaded as a torch.Tensor.
+        device: The device the weights are loaded to.
 
     Returns:
-        The TransformerModel.
-    '''
-    model = TransformerModel(token_dim = model_config["token_dim"], 
-                             d_model = 1280, # each cell is represented as a d-dimensional vector, where d = 1280, see UCE paper. TODO: Can we use `output_dim` from the model_config?
-                             nhead = 20,  # number of heads in nn.MultiheadAttention,
-                             d_hid = model_config['d_hid'],
-                             nlayers = model_config['n_layers'], 
-                             dropout = 0.05,
-                             output_dim = model_config['output_dim'])
-
-    # empty_pe = torch.zeros(50000, 5120)
-    empty_pe = torch.zeros(145469, 5120)
-    empty_pe.requires_grad = False
-    model.pe_embedding = torch.nn.Embedding.from_pretrained(empty_pe)
-    model.load_state_dict(torch.load(model_path, map_location="cpu"), strict=True)
+        The TransformerModel on the given device.
+    '''
+    # the parameters are allocated on the device directly, the weights are then copied into them from the memory-mapped checkpoint
+    with torch.device(device):
+        model = TransformerModel(token_dim = model_config["token_dim"], 
+                                 d_model = 1280, # each cell is represented as a d-dimensional vector, where d = 1280, see UCE paper. TODO: Can we use `output_dim` from the model_config?
+                                 nhead = 20,  # number of heads in nn.MultiheadAttention,
+                                 d_hid = model_config['d_hid'],
+                                 nlayers = model_config['n_layers'], 
+                                 dropout = 0.05,
+                                 output_dim = model_config['output_dim'])
+
+        # empty_pe = torch.zeros(50000, 5120)
+        # every row is overwritten by the checkpoint, no need to fill it with zeros first
+        empty_pe = torch.empty(145469, 5120)
+        empty_pe.requires_grad = False
+        model.pe_embedding = torch.nn.Embedding.from_pretrained(empty_pe)
+    model.load_state_dict(_load_state_dict(str(model_path)), strict=True)
 
     # TODO: Why load the protein embeddings from the `all_tokens.torch` file, pass it to this function but never use it?
     # Cause in the lines above, we populate model.pe_embeddings with the empty_pe and this if clause will be true with the
@@ -205,40 +287,157 @@ def load_model(model_path: Union[str, Path], model_config: Dict[str, str], all_p
     # This will make sure that you don't overwrite the tokens in case you're embedding species from the training data
     # We avoid doing that just in case the random seeds are different across different versions. 
     if all_pe.shape[0] != 145469: 
-        all_pe.requires_grad = False
-        model.pe_embedding = torch.nn.Embedding.from_pretrained(all_pe)
+        # copied, so the cached table is not shared with the model, even on the CPU
+        model.pe_embedding = torch.nn.Embedding.from_pretrained(all_pe.to(device, copy=True))
     
     return model
 
+# the cached tensors are never used as parameters: load_state_dict copies the weights into the parameters of the model,
+# so the cache is never modified and holds no device memory. Memory-mapping the checkpoint only reads its pages while they are copied
+@lru_cache(maxsize=1)
+def _load_state_dict(model_path: str) -> Dict[str, torch.Tensor]:
+    return torch.load(model_path, map_location="cpu", mmap=True, weights_only=True)
+
+def preload_batches(dataloader: DataLoader, device: torch.device, max_memory_fraction: float = 0.5) -> Optional[list]:
+    '''
+    Copies all the batches of the dataloader to the GPU, if they fit in a fraction of the free GPU memory.
+    The memory needed is bounded before iterating, from sequences of pad_length for every cell. Iterating only to fall back afterwards
+    would consume the random state of the cell sentence sampling, and change the embeddings compared to not preloading.
+
+    Args:
+        dataloader: The DataLoader with the processed data
+        device: The CUDA device to copy the batches to
+        max_memory_fraction: The fraction of the free GPU memory the batches may use
+
+    Returns:
+        The list of batches on the GPU, or None if they do not fit.
+    '''
+    free_memory, _ = torch.cuda.mem_get_info(device)
+    # int64 token ids and a float32 mask per position
+    bytes_per_cell = dataloader.dataset.config["pad_length"] * (torch.int64.itemsize + torch.float32.itemsize)
+    needed_memory = bytes_per_cell * len(dataloader.dataset)
+    if needed_memory > max_memory_fraction * free_memory:
+        LOGGER.info(f"The batches need up to {needed_memory / 1e9:.2f} GB, which is more than {max_memory_fraction} of the free GPU memory. They will not be preloaded.")
+        return None
+    # only the batch sentences and the mask are needed for the inference
+    return [[b.to(device) for b in batch[:2]] for batch in dataloader]
+
+def embed_and_normalize(pe_embedding: torch.nn.Embedding, ids: torch.Tensor) -> torch.Tensor:
+    """Looks up the protein embeddings of the token ids and normalizes them along the embedding dimension.
+    Kept as a separate function so that it can be compiled, which fuses the lookup and the normalization into one pass over the embeddings.
+
+    Parameters
+    ----------
+    pe_embedding : torch.nn.Embedding
+        The protein embedding table of the model.
+    ids : torch.Tensor
+        The token ids of shape (seq_len, batch_size).
+
+    Returns
+    -------
+    torch.Tensor
+        The normalized token embeddings of shape (seq_len, batch_size, token_dim).
+    """
+    return torch.nn.functional.normalize(pe_embedding(ids), dim=2)
+
+def tune_batch_size(model, pe_embedding: torch.nn.Embedding, model_config: Dict[str, str], autocast_dtype: Optional[torch.dtype] = None, 
+                    embed_fn=embed_and_normalize, max_batch_size: int = 1024) -> int:
+    '''
+    Find the largest batch size for which the inference fits in the GPU memory, by doubling the batch size of a dummy batch of full length until it runs out of memory.
+
+    Args:
+        model: The UCE model on the GPU
+        pe_embedding: The protein embedding table of the model
+        model_config: The model configuration, with 'pad_length' as key
+        autocast_dtype: The dtype used for inference under autocast, if any
+        embed_fn: The function looking up and normalizing the protein embeddings
+        max_batch_size: The largest batch size tried
+
+    Returns:
+        90% of the largest batch size that fits, leaving some margin for the memory fragmentation of the real batches.
+    '''
+    device = next(model.parameters()).device
+    seq_len = model_config["pad_length"]
+    autocast = torch.autocast(device_type="cuda", dtype=autocast_dtype) if autocast_dtype is not None else contextlib.nullcontext()
+
+    batch_size = 1
+    largest_batch_size = None
+    with torch.inference_mode(), autocast:
+        while batch_size <= max_batch_size:
+            try:
+                batch_sentences = torch.zeros((seq_len, batch_size), dtype=torch.long, device=device)
+                mask = torch.ones((batch_size, seq_len), device=device)
+                model.forward(embed_fn(pe_embedding, batch_sentences), mask=mask)
+                torch.cuda.synchronize(device)
+            except torch.cuda.OutOfMemoryError:
+                break
+            finally:
+                batch_sentences = mask = None
+                torch.cuda.empty_cache()
+            largest_batch_size = batch_size
+            batch_size *= 2
+
+    if largest_batch_size is None:
+        raise RuntimeError("Not even a single cell fits in the GPU memory.")
+    return max(1, int(largest_batch_size * 0.9))
+
 # Create a function that uses the model to get the embeddings of the genes
-def get_gene_embeddings(model, dataloader, accelerator, model_config=None):
+def get_gene_embeddings(model, dataloader, accelerator, model_config=None, autocast_dtype=None, preload_to_device=False, embed_fn=embed_and_normalize, pe_embedding=None, use_cuda_graph=False):
+
+    device = next(model.parameters()).device
+    if pe_embedding is None:
+        pe_embedding = model.module.pe_embedding if model_config and model_config["multi_gpu"] else model.pe_embedding
+    num_cells = len(dataloader.dataset)
+    output = None
+    offset = 0
+    batches = None
+    if preload_to_device and device.type == "cuda":
+        batches = preload_batches(dataloader, device)
 
     # disable progress bar if not the main process
-    if accelerator is not None:
-        pbar = tqdm(dataloader, disable=not accelerator.is_local_main_process)
-    else:
-        pbar = tqdm(dataloader)
-    dataset_embeds = []
+    pbar = tqdm(batches if batches is not None else dataloader, disable=accelerator is not None and not accelerator.is_local_main_process)
+    if batches is None and device.type == "cuda":
+        # the cell sentences and indexes of the batches are not used here, only the batch sentences and the mask are copied
+        pbar = CUDAPrefetcher(pbar, device, keys=(0, 1))
     
-    # disabling gradient calculation for inference
-    with torch.no_grad():
+    use_cuda_graph = use_cuda_graph and device.type == "cuda"
+    if autocast_dtype is not None:
+        # the casts cached by autocast would be freed after the capture of a CUDA graph
+        autocast = torch.autocast(device_type="cuda", dtype=autocast_dtype, cache_enabled=not use_cuda_graph)
+    else:
+        autocast = contextlib.nullcontext()
+
+    def forward(batch_sentences, mask):
+        _, embedding = model.forward(embed_fn(pe_embedding, batch_sentences), mask=mask)
+        # numpy has no bfloat16, keep the cell embeddings in fp32
+        return embedding.float()
+
+    if use_cuda_graph:
+        forward = CUDAGraphForward(forward)
+
+    # inference mode also skips the version counter and view tracking that no_grad still does
+    with torch.inference_mode(), autocast:
         for batch in pbar:
-            batch_sentences, mask, idxs = batch[0], batch[1], batch[2]
-            batch_sentences = batch_sentences.permute(1, 0)
-            if model_config and model_config["multi_gpu"]:
-                batch_sentences = model.module.pe_embedding(batch_sentences.long())
-            else:
-                batch_sentences = model.pe_embedding(batch_sentences.long())
-            batch_sentences = torch.nn.functional.normalize(batch_sentences, dim=2)  # normalize token outputs
-            _, embedding = model.forward(batch_sentences, mask=mask)
+            batch_sentences, mask = batch[0], batch[1]
+            batch_sentences = batch_sentences.to(device, non_blocking=True)
+            mask = mask.to(device, non_blocking=True)
+            embedding = forward(batch_sentences, mask)
             
-            # Fix for duplicates in last batch
             if accelerator is not None:
                 accelerator.wait_for_everyone()
-                embeddings = accelerator.gather_for_metrics((embedding))
-                if accelerator.is_main_process:
-                    dataset_embeds.append(embeddings.detach().cpu().numpy())
-            else:
-                dataset_embeds.append(embedding.detach().cpu().numpy())
+                # gather_for_metrics can not be used here, the prefetcher runs one batch ahead of the loop
+                # which would make accelerate consider the wrong batch as the last one
+                embedding = accelerator.gather((embedding))
+
+            if output is None:
+                # the embedding size is only known from the first batch. The buffer is page-locked so that the non_blocking copies
+                # of the batches below are truly asynchronous, torch.cuda.synchronize after the loop waits for all of them
+                output = torch.empty((num_cells, embedding.shape[1]), dtype=torch.float32, pin_memory=device.type == "cuda")
+            # Fix for duplicates in last batch: the samples added to even out the batches across processes come last
+            num_new_cells = min(len(embedding), num_cells - offset)
+            output[offset:offset + num_new_cells].copy_(embedding[:num_new_cells], non_blocking=True)
+            offset += num_new_cells
 
-    return np.vstack(dataset_embeds)
\ No newline at end of file
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return output.numpy()
\ No newline at end of file